@@ -0,0 +1,174 @@
+import argparse
+import contextlib
+import io
+import json
+import pathlib
+import platform
+import sys
+from functools import partial
+from time import perf_counter
+
+import numpy as np
+
+import generate
+
+
+# Conjuntos de secciones incluidos en examples/
+examples_dir = pathlib.Path(__file__).parent / 'examples'
+benchmarks_dir = pathlib.Path('benchmarks')
+
+RGB_COLORS = (np.array((1., 0., 0.,)), np.array((0., 1., 0.,)), np.array((0., 0., 1.,)))
+
+
+def best_time(fn, repeat):
+    # Mejor tiempo de `repeat` ejecuciones; la salida de create_art se descarta
+    times = []
+    result = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = perf_counter()
+            result = fn()
+            times.append(perf_counter() - start)
+    return min(times), result
+
+def create_nails(shape, layout, nail_step):
+    if layout == 'rect':
+        return generate.create_rectangle_nail_positions(shape, nail_step)
+    return generate.create_circle_nail_positions(shape, nail_step)
+
+def bench_section(input_file, layout, long_side, nail_step, side_len, pulls, repeat, shortlist, pyramid_levels):
+    results = {}
+    img = generate.load_section(input_file, long_side)
+    orig_pic = generate.rgb2gray(img) * 0.9
+    shape = orig_pic.shape
+
+    results['nail_positions'], nails = best_time(lambda: create_nails(shape, layout, nail_step), repeat)
+
+    generate._chord_indices.clear()
+    results['chord_index'], chord_index = best_time(lambda: generate.get_chord_index(nails, shape), 1)
+
+    str_pic = generate.init_canvas(shape)
+    results['find_best_nail_position[loop]'], _ = best_time(
+        lambda: generate.find_best_nail_position(1, nails, str_pic, orig_pic, -0.05, chord_index=chord_index), repeat)
+    results['find_best_nail_position[batch]'], _ = best_time(
+        lambda: generate.find_best_nail_position_batch(1, nails, str_pic, orig_pic, -0.05, chord_index=chord_index), repeat)
+
+    def solve(scoring):
+        str_pic = generate.init_canvas(shape)
+        pull_order = generate.create_art(nails, orig_pic, str_pic, -0.05, i_limit=pulls, chord_index=chord_index,
+                                         scoring=scoring, shortlist=shortlist, pyramid_levels=pyramid_levels)
+        return pull_order, str_pic
+
+    residuals = {}
+    for scoring in generate.SCORERS:
+        if scoring == 'loop':
+            continue
+        results[f'create_art[{scoring}]'], (pull_order, str_pic) = best_time(partial(solve, scoring), repeat)
+        residuals[scoring] = generate.residual_error(str_pic, orig_pic)
+    if generate.njit is not None:
+        # Primera llamada fuera de la medición: incluye la compilación
+        best_time(lambda: generate.create_art(nails, orig_pic, generate.init_canvas(shape), -0.05, i_limit=1,
+                                              chord_index=chord_index, scoring='numba'), 1)
+        results['create_art[numba]'], _ = best_time(
+            lambda: generate.create_art(nails, orig_pic, generate.init_canvas(shape), -0.05, i_limit=pulls,
+                                        chord_index=chord_index, scoring='numba'), repeat)
+
+    scaled_nails = generate.scale_nails(side_len / shape[1], side_len / shape[0], nails)
+    generate.get_chord_index(scaled_nails, (side_len, side_len))
+    results['pull_order_to_array_bw'], _ = best_time(
+        lambda: generate.pull_order_to_array_bw(pull_order, generate.init_canvas((side_len, side_len)),
+                                                scaled_nails, -0.18), repeat)
+    results['pull_order_to_array_rgb'], _ = best_time(
+        lambda: generate.pull_order_to_array_rgb([pull_order] * 3, generate.init_canvas((side_len, side_len, 3)),
+                                                 scaled_nails, RGB_COLORS, -0.18), repeat)
+    return results, residuals
+
+def run(args):
+    results = {}
+    quality = {}
+    for set_name in args.sets:
+        input_files = sorted((examples_dir / f'sections-export-{set_name}').glob('seccion_*.png'))
+        # Secciones repartidas a lo largo del modelo (las de los extremos suelen estar vacías)
+        picks = np.linspace(0, len(input_files) - 1, args.sections + 2).astype(int)[1:-1]
+        for layout in args.layouts:
+            for long_side in args.long_sides:
+                for nail_step in args.nail_steps:
+                    for idx in picks:
+                        input_file = input_files[idx]
+                        print(f"{set_name}/{input_file.name} {layout} LONG_SIDE={long_side} NAIL_STEP={nail_step}")
+                        section, residuals = bench_section(input_file, layout, long_side, nail_step,
+                                                           args.side_len, args.pulls, args.repeat,
+                                                           args.shortlist, args.pyramid_levels)
+                        for metric, seconds in section.items():
+                            key = f'{set_name}/{layout}/L{long_side}/S{nail_step}/{metric}'
+                            results[key] = results.get(key, 0.0) + seconds
+                        # Error residual por sección; 'multires' se compara con el modo exhaustivo 'batch'
+                        quality[f'{set_name}/{layout}/L{long_side}/S{nail_step}/{input_file.stem}'] = residuals
+                        print(f"  residual error: multires {residuals['multires']:.6f} vs batch {residuals['batch']:.6f} "
+                              f"({residuals['multires'] - residuals['batch']:+.6f})")
+    return results, quality
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, seconds in sorted(results.items()):
+        if key not in baseline:
+            continue
+        ratio = seconds / baseline[key] if baseline[key] > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  <-- SLOWER'
+            regressions.append(key)
+        print(f"{key}: {seconds:.4f}s (baseline {baseline[key]:.4f}s, x{ratio:.2f}){flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the generate.py solver and exporters')
+    parser.add_argument('--sets', nargs='+', default=['apple'],
+                        help='example sets under examples/sections-export-*')
+    parser.add_argument('--sections', type=int, default=2, help='sections timed per set')
+    parser.add_argument('--long-sides', nargs='+', type=int, default=[150, 300])
+    parser.add_argument('--nail-steps', nargs='+', type=int, default=[10])
+    parser.add_argument('--layouts', nargs='+', choices=['rect', 'circle'], default=['rect', 'circle'])
+    parser.add_argument('--side-len', type=int, default=800, help='export resolution')
+    parser.add_argument('--pulls', type=int, default=300, help='i_limit for create_art')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--shortlist', type=int, default=16, help="candidates scored at full resolution by 'multires'")
+    parser.add_argument('--pyramid-levels', type=int, default=2, help="downsampling levels used by 'multires'")
+    parser.add_argument('--output', type=pathlib.Path, default=benchmarks_dir / 'results.json')
+    parser.add_argument('--baseline', type=pathlib.Path, default=benchmarks_dir / 'baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown before flagging (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    results, quality = run(args)
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'params': {k: str(v) if isinstance(v, pathlib.Path) else v for k, v in vars(args).items()},
+        'results': results,
+        'residual_error': quality,
+    }
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"Saved to {args.output}")
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        return 0
+
+    regressions = compare(results, json.loads(args.baseline.read_text())['results'], args.threshold)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
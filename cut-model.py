@@ -1,99 +1,71 @@
-import trimesh
-import numpy as np
-import matplotlib.pyplot as plt
+import argparse
 import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import slicing
 
-# model statue
-mesh = trimesh.load('model/model-statue.stl') # Carga el modelo
-num_sections = 42 + 2
-rotation_angle = 45 # Ángulo de rotación en grados alrededor del eje Z (vertical)
-z_min, z_max = mesh.bounds[0][2], mesh.bounds[1][2] #eje z
-directionParam = [0, 0, 1]
-x_limits = (-800, 500)
-y_limits = (-650, 650)
 
-# model ballet
-mesh = trimesh.load('model/model-ballet.stl') # Carga el modelo
-num_sections = 30 + 2
-rotation_angle = 90 # Ángulo de rotación en grados alrededor del eje Z (vertical)
-z_min, z_max = mesh.bounds[0][1], mesh.bounds[1][1] #eje z
-directionParam = [1, 0, 0]
-x_limits = (-1, 1)
-y_limits = (-1, 1)
+def slice_model_to_png(name, model, batched=True):
+    # Carga solo este modelo y guarda sus secciones en sections-export-<modelo>/
+    mesh, z_min, z_max = slicing.load_model(model['path'], model['rotation_angle'], model['direction'],
+                                            model['bounds_axis'])
+    z_positions = np.linspace(z_min, z_max, model['num_sections'])
 
-# model octopus
-mesh = trimesh.load('model/model-octopus.stl') # Carga el modelo
-num_sections = 15 + 2
-rotation_angle = -90 # Ángulo de rotación en grados alrededor del eje Z (vertical)
-z_min, z_max = mesh.bounds[0][2], mesh.bounds[1][2] #eje z
-directionParam = [0, 0, 1]
-x_limits = (-12-5, 12-5)
-y_limits = (-12+3, 12+3)
+    output_dir = pathlib.Path(f'sections-export-{name}')
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for i, mask in slicing.slice_model(mesh, z_positions, model['x_limits'], model['y_limits'], batched=batched):
+        slicing.save_section(mask, output_dir / slicing.section_name(i))
+    return output_dir
 
-# model deer
-mesh = trimesh.load('model/model-deer.stl') # Carga el modelo
-num_sections = 30 + 2
-rotation_angle = -90 # Ángulo de rotación en grados alrededor del eje Z (vertical)
-z_min, z_max = mesh.bounds[0][2], mesh.bounds[1][2] #eje z
-directionParam = [0, 0, 1]
-x_limits = (-12+0, 12+0)
-y_limits = (-12-5, 12-5)
+def solve_model(name, model, debug_sections=False):
+    # Corta el modelo en memoria y resuelve sus secciones con generate.py; las instrucciones se guardan
+    # en texto y en binario (instruction_file.py). Con debug_sections, las secciones tal como las ve el
+    # solucionador (a LONG_SIDE) van a sections-solved-<modelo>/, sin pisar las de sections-export-<modelo>/
+    import generate  # Solo se necesita (con skimage y matplotlib) al resolver
 
-# model apple
-mesh = trimesh.load('model/model-apple.stl') # Carga el modelo
-num_sections = 20 + 2
-rotation_angle = 0 # Ángulo de rotación en grados alrededor del eje Z (vertical)
-z_min, z_max = mesh.bounds[0][2], mesh.bounds[1][2] #eje z
-directionParam = [0, 0, 1]
-x_limits = (-400+0, 400+0)
-y_limits = (-400-0, 400-0)
+    config = dict(generate.DEFAULT_CONFIG)
+    output_dir = pathlib.Path(f'string-sections-{name}')
+    output_dir.mkdir(parents=True, exist_ok=True)
+    binary_path = f'instructions-{name}.bin'
+    with open(f'instructions-{name}.txt', 'w') as f, generate.instruction_file.InstructionWriter(binary_path) as binary:
+        f.write("Instructions:\n\n")
+        debug_dir = pathlib.Path(f'sections-solved-{name}') if debug_sections else None
+        images = generate.stream_model_sections(model, config, debug_dir=debug_dir)
+        generate.process_sections(None, output_dir, f, config, checkpoint_dir=generate.checkpoint_dir / name,
+                                  images=images, report_dir=pathlib.Path(f'metrics-{name}'), binary=binary)
+    return output_dir
 
-# Parámetros
-line_width = 10.0    # Ancho del contorno en píxeles (ajusta según necesidad)
-z_positions = np.linspace(z_min, z_max, num_sections)
+def run_model(name, model, solve=False, batched=True, debug_sections=False):
+    if solve:
+        return solve_model(name, model, debug_sections)
+    return slice_model_to_png(name, model, batched)
 
-# Aplica rotación al modelo en el eje Z
-rotation_matrix = trimesh.transformations.rotation_matrix(
-    angle=np.deg2rad(rotation_angle),  # Convierte a radianes
-    direction=directionParam,              # Rotación en eje Z
-    point=[0, 0, 0]                   # Rota alrededor del origen (0, 0, 0)
-)
-mesh.apply_transform(rotation_matrix)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Cut STL models into cross-sections (and optionally solve them)')
+    parser.add_argument('models', nargs='*', help='models from the config to process (default: all)')
+    parser.add_argument('--config', default='models.json', help='per-model slicing configuration')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='models processed in parallel')
+    parser.add_argument('--solve', action='store_true',
+                        help='also solve each model into string-sections-<model>/ and instructions-<model>.txt')
+    parser.add_argument('--per-plane', action='store_true', help='slice with mesh.section once per plane')
+    parser.add_argument('--debug-sections', action='store_true',
+                        help='with --solve: also save the sections as solved (LONG_SIDE) in sections-solved-<model>/')
+    args = parser.parse_args(argv)
 
-# Configura el tamaño de la imagen y los límites de los ejes
-plt.rcParams['figure.figsize'] = [15.36,15.36]  # Proporción cuadrada para 512x512 píxeles
+    models = slicing.load_model_configs(args.config)
+    names = args.models or list(models)
+    unknown = [name for name in names if name not in models]
+    if unknown:
+        parser.error(f"unknown model(s): {', '.join(unknown)} (available: {', '.join(models)})")
 
-# Crea el directorio sections-export si no existe
-output_dir = 'sections-export'
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
+    # Cada modelo es independiente: se reparten entre procesos y cada uno carga solo su STL
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(names)))) as executor:
+        futures = {name: executor.submit(run_model, name, models[name], args.solve, not args.per_plane,
+                                         args.debug_sections)
+                   for name in names}
+        for name, future in futures.items():
+            print(f"{name}: {future.result()}")
 
-# Genera secciones transversales
-for i, z in enumerate(z_positions):
-    # Define el plano de corte en el sistema de coordenadas global
-    section = mesh.section(plane_origin=[0, 0, z], plane_normal=[0, 0, 1])
-    if section:
-        # Extrae los vértices y entidades de la sección
-        vertices_3d = section.vertices
-        entities = section.entities
-        # Proyecta manualmente al plano XY (ignora Z)
-        vertices_2d = vertices_3d[:, :2]  # Toma solo X e Y
-        # Dibuja la sección
-        plt.figure()
-        for entity in entities:
-            # Obtiene los índices de los vértices para esta entidad
-            points_idx = entity.points
-            # Dibuja las líneas conectando los vértices
-            for j in range(len(points_idx)):
-                start_idx = points_idx[j]
-                end_idx = points_idx[(j + 1) % len(points_idx)]  # Cierra el bucle
-                start_point = vertices_2d[start_idx]
-                end_point = vertices_2d[end_idx]
-                plt.plot([start_point[0], end_point[0]], [start_point[1], end_point[1]], 'k-', linewidth=line_width)
-        plt.axis('equal')
-        plt.xlim(x_limits)
-        plt.ylim(y_limits)
-        plt.gca().set_aspect('equal', adjustable='box')
-        plt.axis('off')  # Oculta los ejes y el recuadro
-        plt.savefig(f'{output_dir}/seccion_{i:03d}.png', dpi=100, bbox_inches='tight', pad_inches=0)  # 512x512 píxeles
-        plt.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
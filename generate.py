@@ -1,18 +1,43 @@
+import argparse
 import numpy as np
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
 from skimage.draw import line_aa, ellipse_perimeter
 from math import atan2
 from skimage.transform import resize
-from time import time
+from time import time, perf_counter
+from functools import partial
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor
 import pathlib
 import os
+import hashlib
+import json
+import csv
+import cProfile
+import pstats
+import tracemalloc
+from collections import deque
+import instruction_file
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    import slicing
+except ImportError:
+    slicing = None
 
 
 # Directorios de entrada y salida
 input_dir = pathlib.Path('sections-export')
 output_dir = pathlib.Path('string-sections')
 instructions_file = 'instructions.txt'
+binary_instructions_file = 'instructions.bin'
+checkpoint_dir = pathlib.Path('checkpoints')
+metrics_dir = pathlib.Path('metrics')
 
 
 def rgb2gray(rgb):
@@ -43,7 +68,7 @@ def create_rectangle_nail_positions(shape, nail_step=2):
     nails_left = [(i, 0) for i in range(offset_left-1+expand, height-1-expand, nail_step)]
     nails = nails_top + nails_right + list(reversed(nails_bot)) + list(reversed(nails_left))
 
-    return np.array(nails)
+    return np.array(nails, dtype=np.int32)
 
 def create_circle_nail_positions(shape, nail_step=2, r1_multip=1, r2_multip=1):
     height = shape[0]
@@ -56,13 +81,17 @@ def create_circle_nail_positions(shape, nail_step=2, r1_multip=1, r2_multip=1):
     nails.sort(key=lambda c: atan2(c[0] - centre[0], c[1] - centre[1]))
     nails = nails[::nail_step]
 
-    return np.asarray(nails)
+    return np.asarray(nails, dtype=np.int32)
 
-def init_canvas(shape, black=False):
+def init_canvas(shape, black=False, dtype=np.float64):
     if black:
-        return np.zeros(shape)
+        return np.zeros(shape, dtype=dtype)
     else:
-        return np.ones(shape)
+        return np.ones(shape, dtype=dtype)
+
+def canvas_dtype(config):
+    # Modo compacto: lienzos en float32 (la mitad de memoria por proceso)
+    return np.float32 if config['compact'] else np.float64
 
 def get_aa_line(from_pos, to_pos, str_strength, picture):
     rr, cc, val = line_aa(from_pos[0], from_pos[1], to_pos[0], to_pos[1])
@@ -71,7 +100,187 @@ def get_aa_line(from_pos, to_pos, str_strength, picture):
 
     return line, rr, cc
 
-def find_best_nail_position(current_idx, nails, str_pic, orig_pic, str_strength, random_nails=None):
+class ChordIndex:
+    # Todas las cuerdas entre pares de puntillas rasterizadas una sola vez (formato CSR):
+    # la cuerda k ocupa offsets[indptr[k]:indptr[k+1]] (índice plano r*ancho+c) y weights (valor AA).
+    # compact: pesos en float32 y posiciones del índice invertido en int32 (la mitad de memoria por proceso)
+    def __init__(self, nails, shape, compact=False):
+        self.nails = np.asarray(nails)
+        self.shape = tuple(shape[:2])
+        width = self.shape[1]
+        n = len(self.nails)
+
+        # Las cuerdas son simétricas, se guarda solo i <= j (la diagonal cubre hilos repetidos)
+        self.pair_ids = np.empty((n, n), dtype=np.int32)
+        offsets = []
+        weights = []
+        lengths = []
+        chord = 0
+        for i in range(n):
+            for j in range(i, n):
+                rr, cc, val = line_aa(self.nails[i][0], self.nails[i][1], self.nails[j][0], self.nails[j][1])
+                offsets.append(rr * width + cc)
+                weights.append(val)
+                lengths.append(len(val))
+                self.pair_ids[i, j] = chord
+                self.pair_ids[j, i] = chord
+                chord += 1
+
+        self.indptr = np.zeros(chord + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.indptr[1:])
+        self.offsets = np.concatenate(offsets).astype(np.int32)
+        self.weights = np.concatenate(weights).astype(np.float32 if compact else np.float64, copy=False)
+        self._pixel_chords = None
+
+    @classmethod
+    def from_arrays(cls, nails, shape, pair_ids, indptr, offsets, weights):
+        # Índice ya rasterizado (p. ej. leído de disco con arrays())
+        chord_index = cls.__new__(cls)
+        chord_index.nails = np.asarray(nails)
+        chord_index.shape = tuple(shape[:2])
+        chord_index.pair_ids = pair_ids
+        chord_index.indptr = indptr
+        chord_index.offsets = offsets
+        chord_index.weights = weights
+        chord_index._pixel_chords = None
+        return chord_index
+
+    def arrays(self):
+        return {'pair_ids': self.pair_ids, 'indptr': self.indptr, 'offsets': self.offsets, 'weights': self.weights}
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def chord(self, from_idx, to_idx):
+        k = self.pair_ids[from_idx, to_idx]
+        start, end = self.indptr[k], self.indptr[k + 1]
+        return self.offsets[start:end], self.weights[start:end]
+
+    def line(self, from_idx, to_idx):
+        offs, val = self.chord(from_idx, to_idx)
+        rr, cc = np.divmod(offs, self.shape[1])
+        return rr, cc, val
+
+    def gather(self, chord_ids):
+        # Concatena los píxeles de varias cuerdas; seg_starts marca el inicio de cada una
+        starts = self.indptr[chord_ids]
+        lengths = self.indptr[np.asarray(chord_ids) + 1] - starts
+        seg_starts = np.zeros(len(lengths), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=seg_starts[1:])
+        positions = np.repeat(starts - seg_starts, lengths) + np.arange(seg_starts[-1] + lengths[-1])
+        return self.offsets[positions], self.weights[positions], seg_starts
+
+    def pixel_chords(self):
+        # Índice invertido píxel -> cuerdas que lo atraviesan (se construye una vez, bajo demanda)
+        if self._pixel_chords is None:
+            chord_of_entry = np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.indptr))
+            order = np.argsort(self.offsets, kind='stable')
+            compact = self.weights.dtype == np.float32
+            pixel_indptr = np.zeros(self.shape[0] * self.shape[1] + 1, dtype=np.int32 if compact else np.int64)
+            np.cumsum(np.bincount(self.offsets, minlength=len(pixel_indptr) - 1), out=pixel_indptr[1:])
+            self._pixel_chords = (pixel_indptr, chord_of_entry[order], self.weights[order])
+        return self._pixel_chords
+
+    def chords_through(self, offs):
+        # Para cada píxel de offs: las cuerdas que lo cruzan, su peso AA ahí y la posición del píxel en offs
+        pixel_indptr, chords, weights = self.pixel_chords()
+        starts = pixel_indptr[offs]
+        lengths = pixel_indptr[offs + 1] - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return chords[positions], weights[positions], np.repeat(np.arange(len(offs)), lengths)
+
+_chord_indices = {}
+
+def get_chord_index(nails, shape, cache_dir=None, compact=False):
+    # Reutiliza el índice entre iteraciones y entre secciones con la misma distribución de puntillas;
+    # con cache_dir también entre procesos y ejecuciones (chords-<hash>.npz). compact: ver ChordIndex
+    nails = np.asarray(nails, dtype=np.int64)
+    key = (tuple(shape[:2]), nails.shape, nails.tobytes(), compact)
+    path = None
+    if cache_dir is not None:
+        params = [[int(side) for side in key[0]], key[1]] + (['compact'] if compact else [])
+        digest = hashlib.sha256(json.dumps(params).encode() + key[2]).hexdigest()
+        path = pathlib.Path(cache_dir) / f"chords-{digest}.npz"
+
+    chord_index = _chord_indices.get(key)
+    if chord_index is None and path is not None and path.exists():
+        with np.load(path) as data:
+            chord_index = ChordIndex.from_arrays(nails, shape, **{name: data[name] for name in data.files})
+    elif chord_index is None:
+        chord_index = ChordIndex(nails, shape, compact)
+    # Un índice ya en memoria también se guarda, así lo leen los procesos que lo piden después
+    if path is not None and not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        save_npz(path, **chord_index.arrays())
+
+    _chord_indices[key] = chord_index
+    return chord_index
+
+def get_cached_aa_line(chord_index, from_idx, to_idx, str_strength, picture):
+    offs, val = chord_index.chord(from_idx, to_idx)
+    line = picture.reshape(-1)[offs] + str_strength * val
+    line = np.clip(line, a_min=0, a_max=1)
+
+    return line, offs
+
+_candidate_masks = {}
+
+def candidate_mask(nails_amount, exclusion=1):
+    # allowed[i, j]: la puntilla j es un destino válido desde i, a más de `exclusion` posiciones
+    # (1 = ni la misma ni sus adyacentes; más alto fuerza un largo mínimo de cuerda). Las distribuciones
+    # son cerradas, así que la distancia es circular; con 1 se mantiene la lineal del solucionador
+    # original (la primera y la última puntilla no cuentan como adyacentes) para no cambiar los recorridos
+    key = (nails_amount, exclusion)
+    if key not in _candidate_masks:
+        ids = np.arange(nails_amount)
+        distance = np.abs(ids[:, None] - ids[None, :])
+        if exclusion > 1:
+            distance = np.minimum(distance, nails_amount - distance)
+        _candidate_masks[key] = distance > exclusion
+    return _candidate_masks[key]
+
+def destination_ids(start_idx, nails_amount, random_nails=None, allowed=None, rng=None):
+    # Puntillas destino desde start_idx: toda la fila permitida o, con random_nails, una muestra de rng
+    if allowed is None:
+        allowed = candidate_mask(nails_amount)
+    if random_nails is None:
+        return np.flatnonzero(allowed[start_idx])
+    if rng is None:
+        rng = np.random.default_rng()
+    nail_ids = rng.choice(nails_amount, size=random_nails, replace=False)
+    return nail_ids[allowed[start_idx, nail_ids]]
+
+# Fases medidas en cada iteración de create_art cuando hay un hook de métricas
+PHASES = ('candidates', 'rasterization', 'scoring', 'update')
+
+class PhaseTimer:
+    # Segundos acumulados por fase de la iteración en curso y de toda la ejecución
+    def __init__(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.totals = dict.fromkeys(PHASES, 0.0)
+
+    @contextmanager
+    def phase(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += perf_counter() - start
+
+    def lap(self):
+        # Tiempos de la iteración que termina; se suman a los totales y se reinician
+        times = self.times
+        for name, seconds in times.items():
+            self.totals[name] += seconds
+        self.times = dict.fromkeys(PHASES, 0.0)
+        return times
+
+def timed(timer, name):
+    # Sin timer (sin hook de métricas) no se mide nada
+    return nullcontext() if timer is None else timer.phase(name)
+
+def find_best_nail_position(current_idx, nails, str_pic, orig_pic, str_strength, random_nails=None, chord_index=None,
+                            allowed=None, rng=None, timer=None):
     best_cumulative_improvement = -99999
     best_nail_position = None
     best_nail_idx = None
@@ -88,22 +297,27 @@ def find_best_nail_position(current_idx, nails, str_pic, orig_pic, str_strength,
     for start_idx in adjacent_indices:
         start_position = nails[start_idx]
         
-        # Seleccionar puntillas destino (excluyendo la misma y sus adyacentes)
-        if random_nails is not None:
-            nail_ids = np.random.choice(range(len(nails)), size=random_nails, replace=False)
-            nail_ids = [i for i in nail_ids if i not in [start_idx, start_idx-1, start_idx+1]]
-            nails_and_ids = list(zip(nail_ids, nails[nail_ids]))
-        else:
-            nails_and_ids = [(i, nail) for i, nail in enumerate(nails) 
-                            if i not in [start_idx, start_idx-1, start_idx+1]]
+        # Seleccionar puntillas destino (excluyendo la misma y sus vecinas)
+        with timed(timer, 'candidates'):
+            nail_ids = destination_ids(start_idx, len(nails), random_nails, allowed, rng)
+        nails_and_ids = zip(nail_ids, nails[nail_ids])
 
         for nail_idx, nail_position in nails_and_ids:
-            overlayed_line, rr, cc = get_aa_line(start_position, nail_position, str_strength, str_pic)
+            with timed(timer, 'rasterization'):
+                if chord_index is None:
+                    overlayed_line, rr, cc = get_aa_line(start_position, nail_position, str_strength, str_pic)
+                    str_line = str_pic[rr, cc]
+                    orig_line = orig_pic[rr, cc]
+                else:
+                    overlayed_line, offs = get_cached_aa_line(chord_index, start_idx, nail_idx, str_strength, str_pic)
+                    str_line = str_pic.reshape(-1)[offs]
+                    orig_line = orig_pic.reshape(-1)[offs]
 
-            before_overlayed_line_diff = np.abs(str_pic[rr, cc] - orig_pic[rr, cc])**2
-            after_overlayed_line_diff = np.abs(overlayed_line - orig_pic[rr, cc])**2
+            with timed(timer, 'scoring'):
+                before_overlayed_line_diff = np.abs(str_line - orig_line)**2
+                after_overlayed_line_diff = np.abs(overlayed_line - orig_line)**2
 
-            cumulative_improvement = np.sum(before_overlayed_line_diff - after_overlayed_line_diff)
+                cumulative_improvement = np.sum(before_overlayed_line_diff - after_overlayed_line_diff)
 
             if cumulative_improvement >= best_cumulative_improvement:
                 best_cumulative_improvement = cumulative_improvement
@@ -113,10 +327,458 @@ def find_best_nail_position(current_idx, nails, str_pic, orig_pic, str_strength,
 
     return best_start_idx, best_nail_idx, best_nail_position, best_cumulative_improvement
 
-def create_art(nails, orig_pic, str_pic, str_strength, i_limit=None, last_nail_idx=0):
+def candidate_chords(current_idx, nails_amount, random_nails=None, allowed=None, rng=None):
+    adjacent_indices = []
+    if current_idx > 0:
+        adjacent_indices.append(current_idx - 1)
+    if current_idx < nails_amount - 1:
+        adjacent_indices.append(current_idx + 1)
+
+    # Candidatos de ambas puntillas de partida, en el mismo orden que el recorrido secuencial
+    start_ids = []
+    nail_ids = []
+    for start_idx in adjacent_indices:
+        candidates = destination_ids(start_idx, nails_amount, random_nails, allowed, rng)
+        start_ids.append(np.full(len(candidates), start_idx))
+        nail_ids.append(candidates)
+
+    return np.concatenate(start_ids), np.concatenate(nail_ids)
+
+def score_chords(chord_index, chord_ids, str_pic, orig_pic, str_strength, timer=None):
+    # Error cuadrático antes/después de todas las cuerdas en una sola pasada
+    with timed(timer, 'rasterization'):
+        offs, val, seg_starts = chord_index.gather(chord_ids)
+    with timed(timer, 'scoring'):
+        str_line = str_pic.reshape(-1)[offs]
+        orig_line = orig_pic.reshape(-1)[offs]
+        overlayed_line = np.clip(str_line + str_strength * val, a_min=0, a_max=1)
+        diff = (str_line - orig_line)**2 - (overlayed_line - orig_line)**2
+
+        return np.add.reduceat(diff, seg_starts)
+
+def find_best_nail_position_batch(current_idx, nails, str_pic, orig_pic, str_strength, random_nails=None, chord_index=None,
+                                  allowed=None, rng=None, timer=None):
+    if chord_index is None:
+        chord_index = get_chord_index(nails, str_pic.shape)
+
+    with timed(timer, 'candidates'):
+        start_ids, nail_ids = candidate_chords(current_idx, len(nails), random_nails, allowed, rng)
+
+    if len(nail_ids) == 0:
+        return None, None, None, -99999
+
+    improvements = score_chords(chord_index, chord_index.pair_ids[start_ids, nail_ids], str_pic, orig_pic, str_strength,
+                                timer)
+
+    # Empates: gana el último candidato, igual que la comparación >= del recorrido secuencial
+    best = len(improvements) - 1 - np.argmax(improvements[::-1])
+    best_nail_idx = nail_ids[best]
+
+    return start_ids[best], best_nail_idx, nails[best_nail_idx], improvements[best]
+
+class ImprovementCache:
+    # Tabla de mejora por cuerda, actualizada solo con los píxeles que cambió el último hilo
+    def __init__(self, chord_index, str_pic, orig_pic, str_strength, tolerance=1e-9):
+        self.chord_index = chord_index
+        self.str_pic = str_pic
+        self.orig_pic = orig_pic
+        self.str_strength = str_strength
+        self.tolerance = tolerance
+        self.improvements = score_chords(
+            chord_index, np.arange(len(chord_index)), str_pic, orig_pic, str_strength)
+
+    def pixel_improvement(self, values, orig, weights):
+        overlayed = np.clip(values + self.str_strength * weights, a_min=0, a_max=1)
+        return (values - orig)**2 - (overlayed - orig)**2
+
+    def update(self, offs, previous_line):
+        # Ajusta solo las cuerdas que cruzan los píxeles modificados, por diferencia de su aporte
+        chords, weights, pixel = self.chord_index.chords_through(offs)
+        orig = self.orig_pic.reshape(-1)[offs][pixel]
+        current = self.str_pic.reshape(-1)[offs][pixel]
+        delta = (self.pixel_improvement(current, orig, weights)
+                 - self.pixel_improvement(previous_line[pixel], orig, weights))
+        self.improvements += np.bincount(chords, weights=delta, minlength=len(self.improvements))
+
+    def score(self, chord_ids, timer=None):
+        with timed(timer, 'scoring'):
+            improvements = self.improvements[chord_ids]
+
+            # Los candidatos cerca del máximo se recalculan exactos, así el redondeo acumulado
+            # no cambia la elección ni el criterio de parada respecto al modo 'batch'
+            near_best = np.flatnonzero(improvements >= improvements.max() - self.tolerance)
+        exact = score_chords(self.chord_index, chord_ids[near_best], self.str_pic, self.orig_pic, self.str_strength,
+                             timer)
+        improvements[near_best] = exact
+        self.improvements[chord_ids[near_best]] = exact
+        return improvements
+
+def find_best_nail_position_incremental(current_idx, nails, str_pic, orig_pic, str_strength, random_nails=None, chord_index=None,
+                                        allowed=None, rng=None, improvement_cache=None, timer=None):
+    if chord_index is None:
+        chord_index = get_chord_index(nails, str_pic.shape)
+    if improvement_cache is None:
+        improvement_cache = ImprovementCache(chord_index, str_pic, orig_pic, str_strength)
+
+    with timed(timer, 'candidates'):
+        start_ids, nail_ids = candidate_chords(current_idx, len(nails), random_nails, allowed, rng)
+
+    if len(nail_ids) == 0:
+        return None, None, None, -99999
+
+    improvements = improvement_cache.score(chord_index.pair_ids[start_ids, nail_ids], timer)
+
+    best = len(improvements) - 1 - np.argmax(improvements[::-1])
+    best_nail_idx = nail_ids[best]
+
+    return start_ids[best], best_nail_idx, nails[best_nail_idx], improvements[best]
+
+class PyramidLevel:
+    # Versión reducida (promedio por bloques de factor x factor) de str_pic y orig_pic
+    def __init__(self, nails, str_pic, orig_pic, str_strength, factor):
+        height, width = str_pic.shape
+        self.shape = (-(-height // factor), -(-width // factor))
+        rows, cols = np.indices((height, width))
+        self.block_of = ((rows // factor) * self.shape[1] + cols // factor).reshape(-1)
+        blocks = self.shape[0] * self.shape[1]
+        self.counts = np.bincount(self.block_of, minlength=blocks)
+        self.str_flat = np.bincount(self.block_of, weights=str_pic.reshape(-1), minlength=blocks) / self.counts
+        self.orig_flat = np.bincount(self.block_of, weights=orig_pic.reshape(-1), minlength=blocks) / self.counts
+        # Un hilo de un píxel de ancho oscurece el promedio de un bloque en ~1/factor
+        self.str_strength = str_strength / factor
+        self.chord_index = get_chord_index(np.asarray(nails) // factor, self.shape)
+
+    def score(self, chord_pairs):
+        chord_ids = self.chord_index.pair_ids[chord_pairs]
+        return score_chords(self.chord_index, chord_ids, self.str_flat, self.orig_flat, self.str_strength)
+
+    def update(self, offs, previous_line, current_line):
+        blocks = self.block_of[offs]
+        np.add.at(self.str_flat, blocks, (current_line - previous_line) / self.counts[blocks])
+
+class MultiresScorer:
+    # Preselección gruesa a fina: cada nivel de la pirámide (del más reducido al menos reducido)
+    # conserva los mejores candidatos y solo los `shortlist` finales se evalúan a resolución completa
+    def __init__(self, nails, chord_index, str_pic, orig_pic, str_strength, shortlist=16, pyramid_levels=2):
+        self.chord_index = chord_index
+        self.str_pic = str_pic
+        self.orig_pic = orig_pic
+        self.str_strength = str_strength
+        self.shortlist = shortlist
+        self.levels = [(level, PyramidLevel(nails, str_pic, orig_pic, str_strength, 2**level))
+                       for level in range(pyramid_levels, 0, -1)]
+
+    def shortlist_candidates(self, start_ids, nail_ids):
+        candidates = np.arange(len(nail_ids))
+        for level, pyramid_level in self.levels:
+            keep = self.shortlist * 2**(level - 1)
+            if len(candidates) <= keep:
+                continue
+            improvements = pyramid_level.score((start_ids[candidates], nail_ids[candidates]))
+            # Se conserva el orden original de los candidatos para desempatar igual que el modo exhaustivo
+            candidates = np.sort(candidates[np.argpartition(-improvements, keep - 1)[:keep]])
+        return candidates
+
+    def update(self, offs, previous_line):
+        current_line = self.str_pic.reshape(-1)[offs]
+        for _, pyramid_level in self.levels:
+            pyramid_level.update(offs, previous_line, current_line)
+
+def find_best_nail_position_multires(current_idx, nails, str_pic, orig_pic, str_strength, random_nails=None, chord_index=None,
+                                     allowed=None, rng=None, multires=None, timer=None):
+    if chord_index is None:
+        chord_index = get_chord_index(nails, str_pic.shape)
+    if multires is None:
+        multires = MultiresScorer(nails, chord_index, str_pic, orig_pic, str_strength)
+
+    with timed(timer, 'candidates'):
+        start_ids, nail_ids = candidate_chords(current_idx, len(nails), random_nails, allowed, rng)
+
+    if len(nail_ids) == 0:
+        return None, None, None, -99999
+
+    # La preselección en la pirámide cuenta como puntuación (incluye el trazado de las cuerdas reducidas)
+    with timed(timer, 'scoring'):
+        candidates = multires.shortlist_candidates(start_ids, nail_ids)
+    start_ids = start_ids[candidates]
+    nail_ids = nail_ids[candidates]
+    improvements = score_chords(chord_index, chord_index.pair_ids[start_ids, nail_ids], str_pic, orig_pic, str_strength,
+                                timer)
+
+    best = len(improvements) - 1 - np.argmax(improvements[::-1])
+    best_nail_idx = nail_ids[best]
+
+    return start_ids[best], best_nail_idx, nails[best_nail_idx], improvements[best]
+
+def residual_error(str_pic, orig_pic):
+    return np.mean((str_pic - orig_pic)**2)
+
+def greedy_loop(offsets, weights, indptr, pair_ids, allowed, str_flat, orig_flat, str_strength, current_idx, i_limit):
+    # Bucle voraz completo sobre el índice de cuerdas (i_limit < 0 equivale a None).
+    # Compilado con numba cuando está instalado; mismas reglas que create_art con las políticas por
+    # defecto: sin muestreo aleatorio, el primer paso sin mejora termina el bucle
+    nails_amount = pair_ids.shape[0]
+    pulls = np.empty(1024, dtype=np.int64)
+    count = 0
+    i = 0
+    while True:
+        i += 1
+        if i_limit >= 0 and i > i_limit:
+            break
+
+        best_improvement = -99999.0
+        best_start_idx = -1
+        best_nail_idx = -1
+        for start_idx in (current_idx - 1, current_idx + 1):
+            if start_idx < 0 or start_idx >= nails_amount:
+                continue
+            for nail_idx in range(nails_amount):
+                if not allowed[start_idx, nail_idx]:
+                    continue
+                k = pair_ids[start_idx, nail_idx]
+                improvement = 0.0
+                for p in range(indptr[k], indptr[k + 1]):
+                    before = str_flat[offsets[p]]
+                    orig = orig_flat[offsets[p]]
+                    after = min(max(before + str_strength * weights[p], 0.0), 1.0)
+                    improvement += (before - orig)**2 - (after - orig)**2
+                if improvement >= best_improvement:
+                    best_improvement = improvement
+                    best_start_idx = start_idx
+                    best_nail_idx = nail_idx
+
+        if best_improvement <= 0:
+            break
+
+        if count + 2 > len(pulls):
+            grown = np.empty(2 * len(pulls), dtype=np.int64)
+            grown[:count] = pulls[:count]
+            pulls = grown
+        pulls[count] = best_start_idx
+        pulls[count + 1] = best_nail_idx
+        count += 2
+
+        k = pair_ids[best_start_idx, best_nail_idx]
+        for p in range(indptr[k], indptr[k + 1]):
+            str_flat[offsets[p]] = min(max(str_flat[offsets[p]] + str_strength * weights[p], 0.0), 1.0)
+
+        current_idx = best_nail_idx
+
+    return pulls[:count]
+
+if njit is not None:
+    greedy_loop = njit(cache=True)(greedy_loop)
+
+class PullOrder:
+    # Secuencia de puntillas en un arreglo uint16 preasignado que crece al doble cuando se llena
+    def __init__(self, capacity=1024):
+        self.data = np.empty(capacity, dtype=np.uint16)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, extra):
+        if self.size + extra > len(self.data):
+            grown = np.empty(max(2 * len(self.data), self.size + extra), dtype=np.uint16)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+
+    def append(self, nail_idx):
+        self.reserve(1)
+        self.data[self.size] = nail_idx
+        self.size += 1
+
+    def extend(self, nail_ids):
+        self.reserve(len(nail_ids))
+        self.data[self.size:self.size + len(nail_ids)] = nail_ids
+        self.size += len(nail_ids)
+
+    def array(self):
+        return self.data[:self.size].copy()
+
+SCORERS = {
+    'loop': find_best_nail_position,
+    'batch': find_best_nail_position_batch,
+    'incremental': find_best_nail_position_incremental,
+    'multires': find_best_nail_position_multires,
+}
+
+class StoppingPolicy:
+    # Criterio de parada de create_art: check(progress) devuelve el motivo para parar o None.
+    # progress: iteration (la que va a empezar), pulls (hilos tendidos), fails, residual_error,
+    # elapsed (segundos) y thread_length (largo del hilo en píxeles de la sección)
+    def reset(self):
+        pass
+
+    def check(self, progress):
+        return None
+
+class IterationLimit(StoppingPolicy):
+    # i_limit de create_art: iteraciones, contando las que no mejoran
+    def __init__(self, limit):
+        self.limit = limit
+
+    def check(self, progress):
+        if progress['iteration'] > self.limit:
+            return f"iterations > {self.limit}"
+
+class FailLimit(StoppingPolicy):
+    # Pasos sin mejora. Sin muestreo aleatorio basta uno: el paso siguiente evaluaría los mismos
+    # candidatos sobre el mismo lienzo y fallaría igual
+    def __init__(self, limit=3):
+        self.limit = limit
+
+    def check(self, progress):
+        if progress['fails'] >= self.limit:
+            return f"fails >= {self.limit}"
+
+class PullLimit(StoppingPolicy):
+    def __init__(self, max_pulls):
+        self.max_pulls = max_pulls
+
+    def check(self, progress):
+        if progress['pulls'] >= self.max_pulls:
+            return f"pulls >= {self.max_pulls}"
+
+class TimeBudget(StoppingPolicy):
+    # Segundos por sección (por llamada a create_art)
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def check(self, progress):
+        if progress['elapsed'] >= self.seconds:
+            return f"time >= {self.seconds}s"
+
+class ThreadLength(StoppingPolicy):
+    # Largo físico del hilo: pixel_size es el tamaño de un píxel de la sección resuelta en las
+    # mismas unidades que max_length (p. ej. mm)
+    def __init__(self, max_length, pixel_size):
+        self.max_length = max_length
+        self.pixel_size = pixel_size
+
+    def check(self, progress):
+        if progress['thread_length'] * self.pixel_size >= self.max_length:
+            return f"thread length >= {self.max_length}"
+
+class ImprovementWindow(StoppingPolicy):
+    # Rendimientos decrecientes: los últimos `window` hilos redujeron el error residual menos de
+    # `threshold` (relativo al error de hace `window` hilos)
+    def __init__(self, threshold=1e-3, window=200):
+        self.threshold = threshold
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.residuals = deque(maxlen=self.window + 1)
+        self.pulls = None
+
+    def check(self, progress):
+        if progress['pulls'] != self.pulls:
+            self.pulls = progress['pulls']
+            self.residuals.append(progress['residual_error'])
+        if len(self.residuals) > self.window:
+            before = self.residuals[0]
+            if before <= 0 or (before - self.residuals[-1]) / before < self.threshold:
+                return f"residual improvement < {self.threshold} over {self.window} pulls"
+
+def default_stopping(i_limit, random_nails):
+    # Las reglas de siempre: i_limit iteraciones o, sin límite, hasta que los pasos dejen de mejorar
+    # (con random_nails, 3 fallos: otra muestra puede mejorar)
+    if random_nails is None:
+        policies = [FailLimit(1)]
+    elif i_limit is None:
+        policies = [FailLimit(3)]
+    else:
+        policies = []
+    if i_limit is not None:
+        policies.append(IterationLimit(i_limit))
+    return policies
+
+def stop_reason(policies, progress):
+    # Motivo de la primera política que pide parar, o None
+    for policy in policies:
+        reason = policy.check(progress)
+        if reason is not None:
+            return reason
+    return None
+
+def chord_length(nails, from_idx, to_idx):
+    return float(np.hypot(*(np.asarray(nails[to_idx], dtype=float) - nails[from_idx])))
+
+def create_art(nails, orig_pic, str_pic, str_strength, i_limit=None, last_nail_idx=0, chord_index=None, scoring='incremental',
+               shortlist=16, pyramid_levels=2, random_nails=None, exclusion=1, seed=None, allowed=None, on_iteration=None,
+               stopping=None, on_stop=None):
+    # on_iteration: hook opcional que recibe un dict por iteración con las claves de METRIC_FIELDS.
+    # stopping: políticas de parada (StoppingPolicy) que se suman a las de i_limit y los fallos;
+    # on_stop(motivo, progress) recibe la que paró el bucle
     start = time()
     iter_times = []
 
+    if not str_pic.flags.c_contiguous:
+        raise ValueError("str_pic must be a C-contiguous array (use init_canvas)")
+    orig_pic = np.ascontiguousarray(orig_pic)
+    if chord_index is None:
+        chord_index = get_chord_index(nails, str_pic.shape)
+
+    if scoring == 'numba' and njit is None:
+        print("numba is not installed, falling back to scoring='incremental'")
+        scoring = 'incremental'
+    if scoring == 'numba' and random_nails is not None:
+        print("scoring='numba' evaluates every nail, falling back to scoring='incremental' for random_nails")
+        scoring = 'incremental'
+    if scoring == 'numba' and stopping:
+        print("scoring='numba' only stops on i_limit and failures, falling back to scoring='incremental' for stopping")
+        scoring = 'incremental'
+
+    policies = default_stopping(i_limit, random_nails) + list(stopping or [])
+    for policy in policies:
+        policy.reset()
+
+    # Destinos permitidos por puntilla y muestreo reproducible: la misma semilla da el mismo pull_order
+    if allowed is None:
+        allowed = candidate_mask(len(nails), exclusion)
+    rng = np.random.default_rng(seed)
+
+    # Estado del modo de puntuación que se actualiza con cada hilo dibujado
+    scoring_state = None
+    if scoring == 'numba':
+        # El primer hilo se elige en NumPy; el resto del bucle corre compilado
+        find_best = find_best_nail_position_batch
+    elif scoring == 'incremental':
+        scoring_state = ImprovementCache(chord_index, str_pic, orig_pic, str_strength)
+        find_best = partial(find_best_nail_position_incremental, improvement_cache=scoring_state)
+    elif scoring == 'multires':
+        scoring_state = MultiresScorer(nails, chord_index, str_pic, orig_pic, str_strength, shortlist, pyramid_levels)
+        find_best = partial(find_best_nail_position_multires, multires=scoring_state)
+    else:
+        find_best = SCORERS[scoring]
+    # Con hook de métricas se mide cada fase. El error total (para las métricas y las políticas de parada)
+    # se mantiene con los píxeles de cada hilo, igual que el largo del hilo tendido
+    timer = PhaseTimer() if on_iteration is not None else None
+    squared_error = float(np.sum((str_pic - orig_pic)**2, dtype=np.float64))
+    thread_length = 0.0
+    find_best = partial(find_best, random_nails=random_nails, allowed=allowed, rng=rng, timer=timer)
+
+    def draw_chord(from_idx, to_idx):
+        nonlocal squared_error, thread_length
+        thread_length += chord_length(nails, from_idx, to_idx)
+        with timed(timer, 'rasterization'):
+            overlayed_line, offs = get_cached_aa_line(chord_index, from_idx, to_idx, str_strength, str_pic)
+        with timed(timer, 'update'):
+            previous_line = str_pic.reshape(-1)[offs]
+            str_pic.reshape(-1)[offs] = overlayed_line
+            if scoring_state is not None:
+                scoring_state.update(offs, previous_line)
+            orig_line = orig_pic.reshape(-1)[offs]
+            squared_error += float(np.sum((str_pic.reshape(-1)[offs] - orig_line)**2, dtype=np.float64)
+                                   - np.sum((previous_line - orig_line)**2, dtype=np.float64))
+
+    def report(iteration, from_idx, to_idx, improvement, fails, started):
+        if on_iteration is not None:
+            on_iteration(iteration_record(iteration, from_idx, to_idx, improvement, squared_error / orig_pic.size,
+                                          fails, started, timer))
+
     # Elegir la ranura inicial como una adyacente a last_nail_idx
     adjacent_indices = []
     if last_nail_idx > 0:
@@ -125,225 +787,949 @@ def create_art(nails, orig_pic, str_pic, str_strength, i_limit=None, last_nail_i
         adjacent_indices.append(last_nail_idx + 1)
     
     # Evaluar cuál adyacente es mejor como punto de partida para el primer hilo
+    first_started = perf_counter()
     best_start_idx = adjacent_indices[0]  # Por defecto, el primero disponible
     best_initial_improvement = -99999
     best_first_nail_idx = None
-    best_first_nail_position = None
     
     for start_idx in adjacent_indices:
-        start_position = nails[start_idx]
         # Evaluar el mejor destino para el primer hilo
-        _, temp_nail_idx, temp_nail_position, temp_improvement = find_best_nail_position(
-            start_idx, nails, str_pic, orig_pic, str_strength)
+        _, temp_nail_idx, _, temp_improvement = find_best(
+            start_idx, nails, str_pic, orig_pic, str_strength, chord_index=chord_index)
         if temp_improvement > best_initial_improvement:
             best_initial_improvement = temp_improvement
             best_start_idx = start_idx
             best_first_nail_idx = temp_nail_idx
-            best_first_nail_position = temp_nail_position
 
     # Iniciar el pull_order con la ranura inicial y el primer destino
     current_idx = best_start_idx
-    pull_order = [best_start_idx]
+    pull_order = PullOrder()
+    pull_order.append(best_start_idx)
     
     # Dibujar el primer hilo desde best_start_idx a best_first_nail_idx
     if best_first_nail_idx is not None:
-        best_overlayed_line, rr, cc = get_aa_line(
-            nails[best_start_idx], best_first_nail_position, str_strength, str_pic)
-        str_pic[rr, cc] = best_overlayed_line
+        draw_chord(best_start_idx, best_first_nail_idx)
         pull_order.append(best_first_nail_idx)
         current_idx = best_first_nail_idx
+    report(0, best_start_idx, best_first_nail_idx, best_initial_improvement, 0, first_started)
+
+    if scoring == 'numba':
+        if on_iteration is not None:
+            print("scoring='numba' runs the loop compiled: per-iteration metrics cover only the first pull")
+        pulls = greedy_loop(chord_index.offsets, chord_index.weights, chord_index.indptr, chord_index.pair_ids, allowed,
+                            str_pic.reshape(-1), orig_pic.reshape(-1), float(str_strength), current_idx,
+                            -1 if i_limit is None else i_limit)
+        pull_order.extend(pulls)
+        # greedy_loop para en i_limit o en el primer paso sin mejora: se reconstruye el progreso final
+        # para informar la política igual que el bucle en Python
+        pull_ids = pull_order.array()
+        steps = np.diff(np.asarray(nails, dtype=float)[pull_ids], axis=0)
+        fails = 0 if i_limit is not None and len(pulls) // 2 >= i_limit else 1
+        progress = {'iteration': len(pulls) // 2 + fails + 1, 'pulls': len(pull_ids) // 2, 'fails': fails,
+                    'residual_error': residual_error(str_pic, orig_pic), 'elapsed': time() - start,
+                    'thread_length': float(np.hypot(*steps.T).sum())}
+        reason = stop_reason(policies, progress)
+        print(f"Time: {time() - start}")
+        print(f"Avg iteration time: {(time() - start) / max(len(pulls) // 2, 1)}")
+        print(f"Residual error: {progress['residual_error']}")
+        print(f"Stopped by: {reason}")
+        if on_stop is not None:
+            on_stop(reason, progress)
+        return pull_ids
 
     i = 0
     fails = 0
     while True:
-        start_iter = time()
+        start_iter = perf_counter()
 
         i += 1
         
         if i % 500 == 0:
             print(f"Iteration {i}")
         
-        if i_limit is None:
-            if fails >= 3:
-                break
-        else:
-            if i > i_limit:
-                break
+        progress = {'iteration': i, 'pulls': len(pull_order) // 2, 'fails': fails,
+                    'residual_error': squared_error / orig_pic.size, 'elapsed': time() - start,
+                    'thread_length': thread_length}
+        reason = stop_reason(policies, progress)
+        if reason is not None:
+            break
 
-        start_idx, best_nail_idx, best_nail_position, best_cumulative_improvement = find_best_nail_position(
-            current_idx, nails, str_pic, orig_pic, str_strength)
+        start_idx, best_nail_idx, _, best_cumulative_improvement = find_best(
+            current_idx, nails, str_pic, orig_pic, str_strength, chord_index=chord_index)
 
         if best_cumulative_improvement <= 0:
             fails += 1
+            report(i, start_idx, best_nail_idx, best_cumulative_improvement, fails, start_iter)
             continue
 
         pull_order.append(start_idx)
         pull_order.append(best_nail_idx)
         
-        best_overlayed_line, rr, cc = get_aa_line(nails[start_idx], best_nail_position, str_strength, str_pic)
-        str_pic[rr, cc] = best_overlayed_line
+        # Salto a la puntilla adyacente desde la que parte el hilo
+        thread_length += chord_length(nails, current_idx, start_idx)
+        draw_chord(start_idx, best_nail_idx)
 
         current_idx = best_nail_idx
-        iter_times.append(time() - start_iter)
+        report(i, start_idx, best_nail_idx, best_cumulative_improvement, fails, start_iter)
+        iter_times.append(perf_counter() - start_iter)
+
+    print(f"Time: {time() - start}")
+    print(f"Avg iteration time: {np.mean(iter_times) if iter_times else 0.0}")
+    print(f"Residual error: {residual_error(str_pic, orig_pic)}")
+    print(f"Stopped by: {reason}")
+    if on_stop is not None:
+        on_stop(reason, progress)
+    if timer is not None:
+        print("Phase times: " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timer.totals.items()))
+    return pull_order.array()
+
+class PaletteCache:
+    # Como ImprovementCache, sobre un lienzo (alto, ancho, canales) y varios colores de hilo. La mejora de
+    # un hilo es la suma de las de los canales que cambia, así que la tabla se guarda por término
+    # (canal, efecto): cada término se calcula una vez aunque lo compartan varios colores, los canales
+    # que un color no cambia no se calculan, y cada hilo solo actualiza los términos de sus canales.
+    # Con la paleta por defecto (un hilo por canal) son tres tablas de un canal, como ImprovementCache.
+    # effects[k]: cuánto cambia cada canal un hilo del color k (ver thread_effects)
+    def __init__(self, chord_index, str_pic, orig_pic, str_strength, effects, tolerance=1e-9):
+        self.chord_index = chord_index
+        self.str_flat = str_pic.reshape(-1, str_pic.shape[-1])
+        self.orig_flat = orig_pic.reshape(-1, orig_pic.shape[-1])
+        self.effects = str_strength * np.asarray(effects, dtype=str_pic.dtype)
+        self.tolerance = tolerance
+
+        terms = sorted({(channel, effect) for row in self.effects for channel, effect in enumerate(row) if effect != 0})
+        self.term_channels = [channel for channel, _ in terms]
+        self.term_effects = [effect for _, effect in terms]
+        # Términos que suma cada color y términos que cambian al tender un hilo de cada color
+        self.colour_terms = [[t for t, (channel, effect) in enumerate(terms) if row[channel] == effect]
+                             for row in self.effects]
+        self.drawn_terms = [[t for t, channel in enumerate(self.term_channels) if row[channel] != 0]
+                            for row in self.effects]
+        # Tabla (términos, cuerdas): cada fila contigua para las actualizaciones con bincount
+        chord_ids = np.arange(len(chord_index))
+        self.improvements = np.stack([self.score_terms(chord_ids, t) for t in range(len(terms))])
+
+    def pixel_improvement(self, term, values, orig, weights):
+        # Reducción del error de un canal al pasar un hilo con el efecto del término
+        overlayed = np.clip(values + self.term_effects[term] * weights, a_min=0, a_max=1)
+        return (values - orig)**2 - (overlayed - orig)**2
+
+    def score_terms(self, chord_ids, term, timer=None):
+        with timed(timer, 'rasterization'):
+            offs, val, seg_starts = self.chord_index.gather(chord_ids)
+        with timed(timer, 'scoring'):
+            channel = self.term_channels[term]
+            diff = self.pixel_improvement(term, self.str_flat[offs, channel], self.orig_flat[offs, channel], val)
+            return np.add.reduceat(diff, seg_starts)
+
+    def draw(self, offs, val, colour):
+        # Tiende un hilo del color dado; devuelve los valores anteriores de sus píxeles
+        previous_line = self.str_flat[offs]
+        self.str_flat[offs] = np.clip(previous_line + val[:, None] * self.effects[colour], a_min=0, a_max=1)
+        self.update(offs, previous_line, colour)
+        return previous_line
 
+    def update(self, offs, previous_line, colour):
+        # Solo los términos de los canales que cambió el hilo, por diferencia de su aporte
+        chords, weights, pixel = self.chord_index.chords_through(offs)
+        for term in self.drawn_terms[colour]:
+            channel = self.term_channels[term]
+            orig = self.orig_flat[offs, channel][pixel]
+            delta = (self.pixel_improvement(term, self.str_flat[offs, channel][pixel], orig, weights)
+                     - self.pixel_improvement(term, previous_line[pixel, channel], orig, weights))
+            self.improvements[term] += np.bincount(chords, weights=delta, minlength=self.improvements.shape[1])
+
+    def score(self, chord_ids, colours, timer=None):
+        # Mejora de cada par (cuerda, color); los cercanos al máximo se recalculan exactos
+        with timed(timer, 'scoring'):
+            improvements = np.zeros(len(chord_ids), dtype=self.improvements.dtype)
+            for colour, terms in enumerate(self.colour_terms):
+                selected = np.flatnonzero(colours == colour)
+                for term in terms:
+                    improvements[selected] += self.improvements[term, chord_ids[selected]]
+            near_best = np.flatnonzero(improvements >= improvements.max() - self.tolerance)
+
+        for colour, terms in enumerate(self.colour_terms):
+            selected = near_best[colours[near_best] == colour]
+            if len(selected) == 0:
+                continue
+            exact = np.zeros(len(selected), dtype=self.improvements.dtype)
+            for term in terms:
+                term_exact = self.score_terms(chord_ids[selected], term, timer)
+                self.improvements[term, chord_ids[selected]] = term_exact
+                exact += term_exact
+            improvements[selected] = exact
+        return improvements
+
+def create_art_joint(nails, orig_pic, str_pic, str_strength, effects, i_limit=None, last_nail_idx=0, chord_index=None,
+                     random_nails=None, exclusion=1, seed=None, allowed=None, on_iteration=None, stopping=None,
+                     on_stop=None):
+    # Solución conjunta de varios colores de hilo sobre un lienzo (alto, ancho, canales): en cada paso se
+    # elige la cuerda y el color con la mayor mejora. Cada color sigue su propio recorrido de puntillas
+    # desde last_nail_idx. Devuelve filas uint16 (color, inicio, fin) en el orden en que se tienden.
+    # Las políticas de parada cuentan los hilos y el largo de todos los colores juntos
+    start = time()
+    iter_times = []
+
+    if not str_pic.flags.c_contiguous:
+        raise ValueError("str_pic must be a C-contiguous array (use init_canvas)")
+    orig_pic = np.ascontiguousarray(orig_pic)
+    if chord_index is None:
+        chord_index = get_chord_index(nails, str_pic.shape)
+    if allowed is None:
+        allowed = candidate_mask(len(nails), exclusion)
+    rng = np.random.default_rng(seed)
+    policies = default_stopping(i_limit, random_nails) + list(stopping or [])
+    for policy in policies:
+        policy.reset()
+
+    palette_cache = PaletteCache(chord_index, str_pic, orig_pic, str_strength, effects)
+    colours_amount = len(palette_cache.effects)
+    current = [last_nail_idx] * colours_amount
+    laid = [False] * colours_amount  # Colores que ya tendieron algún hilo
+    pulls = PullOrder()
+
+    timer = PhaseTimer() if on_iteration is not None else None
+    squared_error = float(np.sum((str_pic - orig_pic)**2, dtype=np.float64))
+    thread_length = 0.0
+
+    def report(iteration, colour, from_idx, to_idx, improvement, fails, started):
+        if on_iteration is not None:
+            record = iteration_record(iteration, from_idx, to_idx, improvement, squared_error / orig_pic.size,
+                                      fails, started, timer)
+            record['colour'] = int(colour)
+            on_iteration(record)
+
+    i = 0
+    fails = 0
+    while True:
+        start_iter = perf_counter()
+
+        i += 1
+
+        if i % 500 == 0:
+            print(f"Iteration {i}")
+
+        progress = {'iteration': i, 'pulls': len(pulls) // 3, 'fails': fails,
+                    'residual_error': squared_error / orig_pic.size, 'elapsed': time() - start,
+                    'thread_length': thread_length}
+        reason = stop_reason(policies, progress)
+        if reason is not None:
+            break
+
+        # Candidatos de todos los colores, cada uno desde su puntilla actual, puntuados juntos
+        with timed(timer, 'candidates'):
+            candidates = [candidate_chords(current[c], len(nails), random_nails, allowed, rng)
+                          for c in range(colours_amount)]
+            start_ids = np.concatenate([starts for starts, _ in candidates])
+            nail_ids = np.concatenate([ends for _, ends in candidates])
+            colours = np.repeat(np.arange(colours_amount), [len(ends) for _, ends in candidates])
+
+        if len(nail_ids) == 0:
+            fails += 1
+            continue
+
+        improvements = palette_cache.score(chord_index.pair_ids[start_ids, nail_ids], colours, timer)
+        best = len(improvements) - 1 - np.argmax(improvements[::-1])
+        colour, start_idx, best_nail_idx = colours[best], start_ids[best], nail_ids[best]
+
+        if improvements[best] <= 0:
+            fails += 1
+            report(i, colour, start_idx, best_nail_idx, improvements[best], fails, start_iter)
+            continue
+
+        with timed(timer, 'rasterization'):
+            offs, val = chord_index.chord(start_idx, best_nail_idx)
+        with timed(timer, 'update'):
+            previous_line = palette_cache.draw(offs, val, colour)
+            orig_line = palette_cache.orig_flat[offs]
+            squared_error += float(np.sum((palette_cache.str_flat[offs] - orig_line)**2, dtype=np.float64)
+                                   - np.sum((previous_line - orig_line)**2, dtype=np.float64))
+
+        # El recorrido de cada color empieza en su primer hilo; después suma el salto a la adyacente
+        if laid[colour]:
+            thread_length += chord_length(nails, current[colour], start_idx)
+        thread_length += chord_length(nails, start_idx, best_nail_idx)
+        laid[colour] = True
+        pulls.extend((colour, start_idx, best_nail_idx))
+        current[colour] = best_nail_idx
+        report(i, colour, start_idx, best_nail_idx, improvements[best], fails, start_iter)
+        iter_times.append(perf_counter() - start_iter)
+
+    pulls = pulls.array().reshape(-1, 3)
     print(f"Time: {time() - start}")
-    print(f"Avg iteration time: {np.mean(iter_times)}")
-    return pull_order
+    print(f"Avg iteration time: {np.mean(iter_times) if iter_times else 0.0}")
+    print(f"Residual error: {residual_error(str_pic, orig_pic)}")
+    print(f"Pulls per colour: {np.bincount(pulls[:, 0], minlength=colours_amount).tolist()}")
+    print(f"Stopped by: {reason}")
+    if on_stop is not None:
+        on_stop(reason, progress)
+    if timer is not None:
+        print("Phase times: " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timer.totals.items()))
+    return pulls
+
+def colour_orders(pulls, colours_amount):
+    # Filas (color, inicio, fin) de create_art_joint -> recorrido de puntillas de cada color, sin relleno
+    pulls = np.asarray(pulls).reshape(-1, 3)
+    return [pulls[pulls[:, 0] == colour, 1:].reshape(-1) for colour in range(colours_amount)]
+
+def interleave_orders(orders):
+    # Recorridos independientes de cada color -> filas uint16 (color, inicio, fin) como las de
+    # create_art_joint, alternando los colores hilo por hilo
+    rows = [np.column_stack((np.full(len(order) // 2, colour), np.asarray(order)[:len(order) // 2 * 2].reshape(-1, 2)))
+            for colour, order in enumerate(orders)]
+    pull_idx = np.concatenate([np.arange(len(colour_rows)) for colour_rows in rows])
+    return np.concatenate(rows)[np.argsort(pull_idx, kind='stable')].astype(np.uint16)
+
+def exit_nail(pull_order, entry_nail):
+    # Última puntilla de la sección (en RGB, la del último hilo tendido); entry_nail si no hubo hilos
+    flat = np.asarray(pull_order).reshape(-1)
+    return int(flat[-1]) if len(flat) else entry_nail
+
+# Claves de cada registro que create_art pasa a on_iteration (y columnas del CSV de MetricsWriter);
+# create_art_joint agrega 'colour'
+METRIC_FIELDS = ('iteration', 'colour', 'start_nail', 'end_nail', 'improvement', 'residual_error', 'fails', 'time') + PHASES
+
+def iteration_record(iteration, from_idx, to_idx, improvement, residual, fails, started, timer):
+    record = {
+        'iteration': iteration,
+        'start_nail': None if from_idx is None else int(from_idx),
+        'end_nail': None if to_idx is None else int(to_idx),
+        'improvement': float(improvement),
+        'residual_error': residual,
+        'fails': fails,
+        'time': perf_counter() - started,
+    }
+    record.update(timer.lap())
+    return record
+
+class MetricsWriter:
+    # Hook para create_art que escribe un registro por iteración en JSONL o, si path termina en .csv, en CSV
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'w', newline='')
+        self.writer = None
+        if self.path.suffix == '.csv':
+            self.writer = csv.DictWriter(self.file, METRIC_FIELDS)
+            self.writer.writeheader()
+
+    def __call__(self, record):
+        if self.writer is None:
+            self.file.write(json.dumps(record) + '\n')
+        else:
+            self.writer.writerow(record)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def profiled(mode, report_path, fn, *args, **kwargs):
+    # Ejecuta fn(*args, **kwargs) bajo cProfile ('cprofile') o tracemalloc ('tracemalloc') y guarda el
+    # informe junto a report_path (.prof y .txt para cProfile, .mem.txt para tracemalloc); None no perfila
+    if mode is None:
+        return fn(*args, **kwargs)
+    report_path = pathlib.Path(report_path)
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(fn, *args, **kwargs)
+        finally:
+            profiler.dump_stats(report_path.with_name(report_path.name + '.prof'))
+            with open(report_path.with_name(report_path.name + '.txt'), 'w') as f:
+                pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(30)
+
+    if mode == 'tracemalloc':
+        tracemalloc.start()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(report_path.with_name(report_path.name + '.mem.txt'), 'w') as f:
+                f.write(f"Current: {current / 2**20:.1f} MiB, peak: {peak / 2**20:.1f} MiB\n\n")
+                for stat in snapshot.statistics('lineno')[:30]:
+                    f.write(f"{stat}\n")
+
+    raise ValueError(f"unknown profile mode {mode!r} (use 'cprofile' or 'tracemalloc')")
 
 def scale_nails(x_ratio, y_ratio, nails):
-    return [(int(y_ratio*nail[0]), int(x_ratio*nail[1])) for nail in nails]
+    return (np.asarray(nails) * (y_ratio, x_ratio)).astype(np.int32)
 
-def pull_order_to_array_bw(order, canvas, nails, strength):
-    for pull_start, pull_end in zip(order, order[1:]):
-        rr, cc, val = line_aa(nails[pull_start][0], nails[pull_start][1],
-                              nails[pull_end][0], nails[pull_end][1])
-        canvas[rr, cc] += val * strength
+def accumulate_chords(canvas_flat, chord_index, chord_ids, chord_values, channels=None, chunk_size=4096):
+    # Suma las cuerdas al lienzo en bloque; np.add.at respeta el orden de chord_ids píxel a píxel,
+    # así el resultado es el mismo que dibujarlas una por una. chord_values(chords, val) da el aporte
+    for chunk_start in range(0, len(chord_ids), chunk_size):
+        chunk = chord_ids[chunk_start:chunk_start + chunk_size]
+        offs, val, seg_starts = chord_index.gather(chunk)
+        chords = np.repeat(np.arange(chunk_start, chunk_start + len(chunk)), np.diff(np.append(seg_starts, len(offs))))
+        values = chord_values(chords, val)
+        if channels is not None:
+            # Lienzo (alto, ancho, canales) aplanado: un índice por píxel y canal
+            offs = (offs.astype(np.int64)[:, None] * channels + np.arange(channels)).reshape(-1)
+            values = values.reshape(-1)
+        np.add.at(canvas_flat, offs, values)
 
-    return np.clip(canvas, a_min=0, a_max=1)
+def pull_order_to_array_bw(order, canvas, nails, strength, chord_index=None):
+    if chord_index is None:
+        chord_index = get_chord_index(nails, canvas.shape)
+    order = np.asarray(order)
+    canvas_flat = canvas.reshape(-1)
+    if len(order) > 1:
+        accumulate_chords(canvas_flat, chord_index, chord_index.pair_ids[order[:-1], order[1:]],
+                          lambda chords, val: val * strength)
 
-def pull_order_to_array_rgb(orders, canvas, nails, colors, strength):
-    color_order_iterators = [iter(zip(order, order[1:])) for order in orders]
-    for _ in range(len(orders[0]) - 1):
-        for color_idx, iterator in enumerate(color_order_iterators):
-            pull_start, pull_end = next(iterator)
-            rr_aa, cc_aa, val_aa = line_aa(
-                nails[pull_start][0], nails[pull_start][1],
-                nails[pull_end][0], nails[pull_end][1]
-            )
+    return np.clip(canvas_flat.reshape(canvas.shape), a_min=0, a_max=1)
 
-            val_aa_colored = np.zeros((val_aa.shape[0], len(colors)))
-            for idx in range(len(val_aa)):
-                val_aa_colored[idx] = np.full(len(colors), val_aa[idx])
+def pull_order_to_array_rgb(orders, canvas, nails, colors, strength, chord_index=None):
+    if chord_index is None:
+        chord_index = get_chord_index(nails, canvas.shape)
+    colors = np.asarray(colors, dtype=float)
+    channels = canvas.shape[-1]
+    canvas_flat = canvas.reshape(-1)
 
-            canvas[rr_aa, cc_aa] += colors[color_idx] * val_aa_colored * strength
+    # Un recorrido por color, no necesariamente del mismo largo; la suma no depende del orden
+    orders = [np.asarray(order, dtype=np.int64) for order in orders]
+    chord_ids = [chord_index.pair_ids[order[:-1], order[1:]] for order in orders]
+    chord_colors = np.repeat(np.arange(len(orders)), [len(ids) for ids in chord_ids])
+    chord_ids = np.concatenate(chord_ids)
+    if len(chord_ids) > 0:
+        accumulate_chords(canvas_flat, chord_index, chord_ids,
+                          lambda chords, val: colors[chord_colors[chords]] * val[:, None] * strength,
+                          channels=channels)
 
-    return np.clip(canvas, a_min=0, a_max=1)
+    return np.clip(canvas_flat.reshape(canvas.shape), a_min=0, a_max=1)
 
-if __name__ == '__main__':
-    # Parámetros fijos
-    LONG_SIDE = 300
-    SIDE_LEN = 800
-    NAIL_STEP = 10
-    EXPORT_STRENGTH = 0.18
-    RECT = True
-    WB = False
-    RGB = False
-    PULL_AMOUNT = None
-    RANDOM_NAILS = None
-    RADIUS1_MULTIPLIER = 1.0
-    RADIUS2_MULTIPLIER = 1.0
+def load_section(input_file, long_side, r1_multip=1.0, r2_multip=1.0):
+    # Leer la imagen
+    img = mpimg.imread(str(input_file))
 
-    # Crear la carpeta de salida si no existe
-    output_dir.mkdir(exist_ok=True)
+    if np.any(img > 100):
+        img = img / 255
 
-    # Inicializar la última ranura como 0 para la primera imagen
-    last_nail_idx = 0
+    if r1_multip == 1 and r2_multip == 1:
+        img = largest_square(img)
+        img = resize(img, (long_side, long_side))
 
-    # Abrir el archivo de instrucciones
-    with open(instructions_file,'a') as f:
-        f.write("Instructions:\n\n")
+    return img
+
+def create_nails(shape, config):
+    if config['rect']:
+        return create_rectangle_nail_positions(shape, config['nail_step'])
+    return create_circle_nail_positions(shape, config['nail_step'], config['r1_multip'], config['r2_multip'])
+
+def export_shape(config):
+    return int(config['side_len'] * config['r1_multip']), int(config['side_len'] * config['r2_multip'])
+
+# Parámetros que definen la distribución de puntillas (además de la forma de la sección)
+GEOMETRY_PARAMS = ('rect', 'nail_step', 'r1_multip', 'r2_multip', 'side_len', 'exclusion')
+
+_geometries = {}
+
+def nail_geometry(shape, config, cache_dir=None):
+    # Puntillas de la sección, puntillas escaladas a la exportación y destinos permitidos por puntilla.
+    # Se calculan una vez por combinación de parámetros; con cache_dir se reutilizan entre procesos y ejecuciones
+    params = {p: config[p] for p in GEOMETRY_PARAMS}
+    params['shape'] = [int(side) for side in shape[:2]]
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    if key in _geometries:
+        return _geometries[key]
+
+    path = None if cache_dir is None else cache_dir / f"{key}.npz"
+    if path is not None and path.exists():
+        with np.load(path) as data:
+            geometry = {name: data[name] for name in data.files}
+    else:
+        nails = create_nails(shape, config)
+        export_height, export_width = export_shape(config)
+        geometry = {
+            'nails': nails,
+            'scaled_nails': scale_nails(export_width / shape[1], export_height / shape[0], nails),
+            'allowed': candidate_mask(len(nails), config['exclusion']),
+        }
+        if path is not None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            save_npz(path, **geometry)
+
+    _geometries[key] = geometry
+    return geometry
+
+def write_stop_report(report_path, reason, progress):
+    # La política que paró la sección y el estado en ese momento, en <sección>.stop.json
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(report_path.with_name(f"{report_path.name}.stop.json"), 'w') as f:
+        json.dump(dict(progress, stopped_by=reason), f)
+
+def solve_channel(nails, orig_pic, black, str_strength, i_limit, last_nail_idx, dtype=np.float64, report_path=None,
+                  metrics=None, profile=None, solver=create_art, geometry_dir=None, **options):
+    # options: argumentos de solver (create_art: scoring, shortlist, random_nails, seed, allowed, ...;
+    # create_art_joint con orig_pic de varios canales: effects, random_nails, seed, allowed).
+    # Con report_path: métricas por iteración en report_path.<metrics> ('jsonl' o 'csv') y
+    # perfil de la ejecución con profile ('cprofile' o 'tracemalloc'); se abren aquí porque el
+    # canal puede resolverse en otro proceso. Con geometry_dir, el índice de cuerdas se lee de disco
+    # en lugar de rasterizarse otra vez en cada proceso (solve_section lo guarda antes)
+    orig_pic = orig_pic.astype(dtype, copy=False)
+    str_pic = init_canvas(orig_pic.shape, black=black, dtype=dtype)
+    chord_index = get_chord_index(nails, orig_pic.shape, geometry_dir, compact=dtype == np.float32)
+    if report_path is None:
+        metrics = profile = on_stop = None
+    else:
+        on_stop = partial(write_stop_report, report_path)
+    with MetricsWriter(report_path.with_name(f"{report_path.name}.{metrics}")) if metrics else nullcontext() as hook:
+        pull_order = profiled(profile, report_path, solver, nails, orig_pic, str_pic, str_strength, i_limit=i_limit,
+                              last_nail_idx=last_nail_idx, chord_index=chord_index, on_iteration=hook, on_stop=on_stop,
+                              **options)
+    return pull_order, str_pic
+
+def stopping_policies(config):
+    # Políticas de parada configuradas (además de pull_amount y de los pasos sin mejora). En RGB sin
+    # 'palette' cada canal se resuelve aparte con su propia copia, así que los límites son por canal
+    policies = []
+    if config['min_improvement'] is not None:
+        policies.append(ImprovementWindow(config['min_improvement'], config['improvement_window']))
+    if config['time_budget'] is not None:
+        policies.append(TimeBudget(config['time_budget']))
+    if config['max_thread_length'] is not None:
+        if config['pixel_size'] is None:
+            raise ValueError("'max_thread_length' needs 'pixel_size' (size of a section pixel in the same units)")
+        policies.append(ThreadLength(config['max_thread_length'], config['pixel_size']))
+    if config['max_pulls'] is not None:
+        policies.append(PullLimit(config['max_pulls']))
+    return policies
+
+def solver_options(config, geometry):
+    return {
+        'stopping': stopping_policies(config),
+        'scoring': config['scoring'],
+        'shortlist': config['shortlist'],
+        'pyramid_levels': config['pyramid_levels'],
+        'random_nails': config['random_nails'],
+        'seed': config['seed'],
+        'allowed': geometry['allowed'],
+    }
+
+def thread_effects(config):
+    # Efecto de cada color de hilo sobre los canales (r, g, b). Sin 'palette', un hilo por canal que
+    # solo cambia ese canal; con 'palette' (colores RGB en [0, 1]), cuánto oscurece cada canal sobre
+    # fondo blanco (1 - color) o cuánto lo aclara sobre fondo negro (color)
+    if config['palette'] is None:
+        return np.eye(3)
+    palette = np.asarray(config['palette'], dtype=float)
+    return palette if config['wb'] else 1 - palette
 
+def solve_section(img, last_nail_idx, config, executor=None, geometry_dir=None, report_path=None):
+    # report_path: ruta base (sin extensión) de las métricas y perfiles de config['metrics'] / config['profile']
+    shape = (len(img), len(img[0]))
+    geometry = nail_geometry(shape, config, geometry_dir)
+    nails = geometry['nails']
+    options = solver_options(config, geometry)
+    options.update(metrics=config['metrics'], profile=config['profile'], geometry_dir=geometry_dir)
+    # El índice de cuerdas se guarda una vez en geometry_dir y los procesos de los canales lo leen de ahí
+    get_chord_index(nails, shape, geometry_dir, compact=config['compact'])
+    print(f"Nails amount: {len(nails)}")
 
-        # Procesar todas las imágenes en la carpeta sections-export
-        for input_file in sorted(input_dir.glob('seccion_*.png')):
+    iteration_strength = 0.1 if config['wb'] else -0.1
+    if config['rgb'] and config['palette'] is None:
+        # Un hilo por canal: cada canal solo depende de sí mismo, así que los tres se resuelven por
+        # separado desde la misma puntilla (en paralelo con executor), más rápido que la solución conjunta
+        args = [(nails, img[:, :, c], config['wb'], iteration_strength, config['pull_amount'], last_nail_idx,
+                 canvas_dtype(config)) for c in range(3)]
+
+        # Un informe por canal: <sección>-r, <sección>-g, <sección>-b
+        reports = [None if report_path is None else report_path.with_name(f"{report_path.name}-{c}") for c in 'rgb']
+        if executor is None:
+            solved = [solve_channel(*a, report_path=r, **options) for a, r in zip(args, reports)]
+        else:
+            solved = [future.result() for future in [executor.submit(solve_channel, *a, report_path=r, **options)
+                                                     for a, r in zip(args, reports)]]
+        return interleave_orders([order for order, _ in solved]), np.dstack([str_pic for _, str_pic in solved])
+
+    if config['rgb']:
+        # Con 'palette' un hilo puede cambiar varios canales: todos los colores se resuelven juntos sobre
+        # un lienzo de tres canales y en cada paso se elige también de qué color tender el siguiente hilo.
+        # pull_amount sigue siendo por color: el total se reparte entre colores según la mejora
+        effects = thread_effects(config)
+        i_limit = None if config['pull_amount'] is None else config['pull_amount'] * len(effects)
+        joint_options = {key: options[key] for key in ('random_nails', 'seed', 'allowed', 'metrics', 'profile', 'stopping',
+                                                      'geometry_dir')}
+        return solve_channel(nails, img[:, :, :3], config['wb'], iteration_strength, i_limit, last_nail_idx,
+                             canvas_dtype(config), report_path, solver=create_art_joint, effects=effects, **joint_options)
+
+    orig_pic = rgb2gray(img) * 0.9
+    return solve_channel(nails, orig_pic, config['wb'], 0.05 if config['wb'] else -0.05,
+                         config['pull_amount'], last_nail_idx, canvas_dtype(config), report_path, **options)
+
+def export_chord_index(shape, config, geometry_dir=None):
+    # Cuerdas rasterizadas a la resolución de exportación; con geometry_dir se guardan junto a la
+    # geometría y se comparten entre procesos y entre ejecuciones con el mismo side_len
+    scaled_nails = nail_geometry(shape, config, geometry_dir)['scaled_nails']
+    return get_chord_index(scaled_nails, export_shape(config), geometry_dir, compact=config['compact'])
+
+def render_section(pull_order, shape, output_file, config, geometry_dir=None):
+    # pull_order: el de solve_section; en RGB también puede ser una lista de recorridos por color
+    # (p. ej. los renglones de un instructions.txt)
+    scaled_nails = nail_geometry(shape, config, geometry_dir)['scaled_nails']
+    chord_index = export_chord_index(shape, config, geometry_dir)
+    strength = config['export_strength'] if config['wb'] else -config['export_strength']
+
+    if config['rgb']:
+        color_image_dimens = export_shape(config) + (3,)
+        print(color_image_dimens)
+        blank = init_canvas(color_image_dimens, black=config['wb'], dtype=canvas_dtype(config))
+        effects = thread_effects(config)
+        orders = pull_order if isinstance(pull_order, list) else colour_orders(pull_order, len(effects))
+        result = pull_order_to_array_rgb(
+            orders,
+            blank,
+            scaled_nails,
+            effects,
+            strength,
+            chord_index
+        )
+    else:
+        blank = init_canvas(export_shape(config), black=config['wb'], dtype=canvas_dtype(config))
+        result = pull_order_to_array_bw(pull_order, blank, scaled_nails, strength, chord_index)
+
+    mpimg.imsave(str(output_file), result, cmap=plt.get_cmap("gray"), vmin=0.0, vmax=1.0)
+    return output_file
+
+def nail_layout(shape, config):
+    # Parámetros que reconstruyen la distribución de puntillas (y los colores) de una sección resuelta
+    layout = {p: config[p] for p in GEOMETRY_PARAMS + ('long_side', 'wb', 'rgb', 'palette')}
+    layout['shape'] = [int(side) for side in shape]
+    return layout
+
+def format_pull_order(pull_order):
+    return '-'.join(map(str, np.asarray(pull_order).tolist()))
+
+# Parámetros por defecto de la solución y la exportación
+DEFAULT_CONFIG = {
+    'long_side': 300,
+    'side_len': 800,
+    'nail_step': 10,
+    'export_strength': 0.18,
+    'rect': True,
+    'wb': False,
+    'rgb': False,
+    'pull_amount': None,
+    'random_nails': None,  # Destinos muestreados por paso (None = todas las puntillas)
+    'seed': None,  # Semilla del muestreo de random_nails: la misma semilla reproduce el mismo pull_order
+    'exclusion': 1,  # Destinos prohibidos a esta distancia de índice o menos (largo mínimo de cuerda)
+    'r1_multip': 1.0,
+    'r2_multip': 1.0,
+    'scoring': 'incremental',  # 'incremental', 'batch' (vectorizado), 'numba' (compilado), 'multires' o 'loop' (candidato por candidato)
+    'shortlist': 16,  # 'multires': candidatos evaluados a resolución completa en cada paso
+    'pyramid_levels': 2,  # 'multires': niveles de reducción (factor 2 por nivel)
+    'compact': False,  # True: lienzos y pesos de cuerdas en float32 (menos memoria por proceso; el PNG puede diferir en 1/255)
+    'metrics': None,  # 'jsonl' o 'csv': métricas por iteración de cada sección en metrics/ (None = sin registro)
+    'profile': None,  # 'cprofile' o 'tracemalloc': perfil de cada sección resuelta en metrics/
+    'palette': None,  # Con rgb: colores de hilo RGB en [0, 1], p. ej. [[0, 0, 0], [1, 0, 0]] (None = un hilo por canal)
+    'min_improvement': None,  # Parar si los últimos improvement_window hilos bajan el error residual menos que esta fracción
+    'improvement_window': 200,
+    'time_budget': None,  # Segundos máximos de solución por sección
+    'max_thread_length': None,  # Largo máximo del hilo por sección, en las unidades de pixel_size
+    'pixel_size': None,  # Tamaño físico de un píxel de la sección resuelta (p. ej. mm), para max_thread_length
+    'max_pulls': None,  # Hilos máximos por sección (en RGB: por canal sin palette, de todos los colores con palette)
+}
+
+# Parámetros que cambian la solución de una sección / solo su exportación
+SOLVE_PARAMS = ('long_side', 'nail_step', 'rect', 'wb', 'rgb', 'pull_amount', 'random_nails', 'r1_multip', 'r2_multip', 'scoring',
+                'shortlist', 'pyramid_levels', 'compact', 'seed', 'exclusion', 'palette', 'min_improvement',
+                'improvement_window', 'time_budget', 'max_thread_length', 'pixel_size', 'max_pulls')
+RENDER_PARAMS = ('side_len', 'export_strength')
+
+def section_hash(source, config, params=SOLVE_PARAMS):
+    # source: ruta del PNG o la imagen ya rasterizada en memoria
+    if isinstance(source, np.ndarray):
+        digest = hashlib.sha256(np.ascontiguousarray(source).tobytes())
+    else:
+        digest = hashlib.sha256(pathlib.Path(source).read_bytes())
+    digest.update(json.dumps({p: config[p] for p in params}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def checkpoint_path(checkpoint_dir, input_file):
+    return checkpoint_dir / f"{input_file.stem}.npz"
+
+def load_checkpoint(checkpoint_dir, input_file, source_hash, last_nail_idx=None):
+    # Devuelve el checkpoint solo si la imagen y los parámetros no cambiaron y la sección
+    # empezó en la misma puntilla (si se indica last_nail_idx)
+    path = checkpoint_path(checkpoint_dir, input_file)
+    if not path.exists():
+        return None
+    with np.load(path) as data:
+        if str(data['source_hash']) != source_hash:
+            return None
+        if last_nail_idx is not None and int(data['entry_nail']) != last_nail_idx:
+            return None
+        return {key: data[key] for key in data.files}
+
+def save_npz(path, **arrays):
+    # Escritura atómica: un corte a mitad de escritura no deja un archivo corrupto, y el
+    # temporal por proceso evita que dos procesos que guardan lo mismo se pisen
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp.npz')
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+def save_checkpoint(checkpoint_dir, input_file, **arrays):
+    save_npz(checkpoint_path(checkpoint_dir, input_file), **arrays)
+
+def mark_rendered(checkpoint_dir, input_file, render_hash):
+    # El render_hash se guarda recién cuando el PNG quedó escrito: si el render falla o se corta,
+    # la próxima ejecución reutiliza la solución pero vuelve a exportar la sección
+    with np.load(checkpoint_path(checkpoint_dir, input_file)) as data:
+        arrays = {key: data[key] for key in data.files}
+    arrays['render_hash'] = render_hash
+    save_checkpoint(checkpoint_dir, input_file, **arrays)
+
+def file_sections(input_files, config, checkpoint_dir=None, executor=None):
+    # (archivo, hash, cargador) de cada PNG; con executor la carga se adelanta en otros procesos
+    source_hashes = [section_hash(f, config) if checkpoint_dir is not None else None for f in input_files]
+    loaded = [None] * len(input_files)
+    if executor is not None:
+        for k, input_file in enumerate(input_files):
+            # Las secciones que probablemente se reutilizan no se cargan por adelantado
+            if checkpoint_dir is None or load_checkpoint(checkpoint_dir, input_file, source_hashes[k]) is None:
+                loaded[k] = executor.submit(load_section, input_file, config['long_side'],
+                                            config['r1_multip'], config['r2_multip'])
+
+    for k, input_file in enumerate(input_files):
+        future, loaded[k] = loaded[k], None
+        if future is None:
+            load = partial(load_section, input_file, config['long_side'], config['r1_multip'], config['r2_multip'])
+        else:
+            load = future.result
+        yield input_file, source_hashes[k], load
+
+def memory_sections(images, config, checkpoint_dir=None):
+    # (nombre, hash, cargador) de imágenes que ya están en memoria, p. ej. de stream_model_sections
+    for name, img in images:
+        source_hash = section_hash(img, config) if checkpoint_dir is not None else None
+        yield pathlib.Path(name), source_hash, lambda img=img: img
+
+def stream_model_sections(model, config, debug_dir=None):
+    # Corta el STL y rasteriza cada sección directamente a LONG_SIDE, sin codificar ni leer PNG ni
+    # reescalar. model: path, num_sections, rotation_angle, direction, bounds_axis, x_limits, y_limits
+    if slicing is None:
+        raise ImportError("slicing.py needs trimesh and pillow: pip install trimesh pillow")
+    mesh, z_min, z_max = slicing.load_model(model['path'], model['rotation_angle'], model['direction'],
+                                            model['bounds_axis'])
+    # Igual que load_section: las distribuciones elípticas conservan la resolución original
+    size = config['long_side'] if config['r1_multip'] == 1 and config['r2_multip'] == 1 else slicing.image_size
+    z_positions = np.linspace(z_min, z_max, model['num_sections'])
+    if debug_dir is not None:
+        debug_dir.mkdir(parents=True, exist_ok=True)
+
+    for i, mask in slicing.slice_model(mesh, z_positions, model['x_limits'], model['y_limits'], size):
+        name = slicing.section_name(i)
+        if debug_dir is not None:
+            slicing.save_section(mask, debug_dir / name)
+        yield name, slicing.mask_to_image(mask)
+
+def process_sections(input_files, output_dir, instructions, config, workers=1, last_nail_idx=0, checkpoint_dir=None,
+                     images=None, report_dir=None, binary=None):
+    # La solución de las secciones es secuencial, en este proceso: cada una empieza en la puntilla donde
+    # terminó la anterior (last_nail_idx), y resolverlas por separado cambiaría instructions.txt. Con
+    # workers > 1 solo se reparten entre procesos la carga y el render de las imágenes (independientes de
+    # last_nail_idx), que se solapan con la solución, y los canales RGB de cada sección (solve_section).
+    # Con checkpoint_dir, cada sección terminada se guarda y las que no cambiaron se saltan.
+    # Con images (iterable de (nombre, imagen)), las secciones llegan en memoria y input_files se ignora.
+    # Las métricas y perfiles de config['metrics'] / config['profile'] van a report_dir (metrics/ por defecto).
+    # Con binary (un instruction_file.InstructionWriter), cada sección se agrega también en formato binario
+    if report_dir is None:
+        report_dir = metrics_dir
+    instrumented = config['metrics'] is not None or config['profile'] is not None
+    # La geometría de puntillas se guarda junto a los checkpoints
+    geometry_dir = None
+    if checkpoint_dir is not None:
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        geometry_dir = checkpoint_dir / 'geometry'
+        render_hash = json.dumps({p: config[p] for p in RENDER_PARAMS}, sort_keys=True)
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        if images is None:
+            sections = file_sections(input_files, config, checkpoint_dir, executor)
+        else:
+            sections = memory_sections(images, config, checkpoint_dir)
+        rendered = []
+
+        for input_file, source_hash, load in sections:
             print(f"Processing {input_file.name}...")
-            f.write(f"{input_file.name}\n")
-            
+            instructions.write(f"{input_file.name}\n")
+
             # Ruta de salida (mismo nombre en string-sections)
             output_file = output_dir / input_file.name
-	    
-            # Leer la imagen
-            img = mpimg.imread(str(input_file))
-            
-            if np.any(img > 100):
-                img = img / 255
-            
-            if RADIUS1_MULTIPLIER == 1 and RADIUS2_MULTIPLIER == 1:
-                img = largest_square(img)
-                img = resize(img, (LONG_SIDE, LONG_SIDE))
-	    
-            shape = (len(img), len(img[0]))
-	    
-            if RECT:
-                nails = create_rectangle_nail_positions(shape, NAIL_STEP)
-            else:
-                nails = create_circle_nail_positions(shape, NAIL_STEP, RADIUS1_MULTIPLIER, RADIUS2_MULTIPLIER)
-	    
-            print(f"Nails amount: {len(nails)}")
-            
-            if RGB:
-                iteration_strength = 0.1 if WB else -0.1
-	    
-                r = img[:,:,0]
-                g = img[:,:,1]
-                b = img[:,:,2]
-                
-                str_pic_r = init_canvas(shape, black=WB)
-                pull_orders_r = create_art(nails, r, str_pic_r, iteration_strength, i_limit=PULL_AMOUNT, last_nail_idx=last_nail_idx)
-	    
-                str_pic_g = init_canvas(shape, black=WB)
-                pull_orders_g = create_art(nails, g, str_pic_g, iteration_strength, i_limit=PULL_AMOUNT, last_nail_idx=last_nail_idx)
-	    
-                str_pic_b = init_canvas(shape, black=WB)
-                pull_orders_b = create_art(nails, b, str_pic_b, iteration_strength, i_limit=PULL_AMOUNT, last_nail_idx=last_nail_idx)
-	    
-                max_pulls = np.max([len(pull_orders_r), len(pull_orders_g), len(pull_orders_b)])
-                pull_orders_r = pull_orders_r + [pull_orders_r[-1]] * (max_pulls - len(pull_orders_r))
-                pull_orders_g = pull_orders_g + [pull_orders_g[-1]] * (max_pulls - len(pull_orders_g))
-                pull_orders_b = pull_orders_b + [pull_orders_b[-1]] * (max_pulls - len(pull_orders_b))
-	    
-                pull_orders = [pull_orders_r, pull_orders_g, pull_orders_b]
-	    
-                color_image_dimens = int(SIDE_LEN * RADIUS1_MULTIPLIER), int(SIDE_LEN * RADIUS2_MULTIPLIER), 3
-                print(color_image_dimens)
-                blank = init_canvas(color_image_dimens, black=WB)
-	    
-                scaled_nails = scale_nails(
-                    color_image_dimens[1] / shape[1],
-                    color_image_dimens[0] / shape[0],
-                    nails
-                )
-	    
-                result = pull_order_to_array_rgb(
-                    pull_orders,
-                    blank,
-                    scaled_nails,
-                    (np.array((1., 0., 0.,)), np.array((0., 1., 0.,)), np.array((0., 0., 1.,))),
-                    EXPORT_STRENGTH if WB else -EXPORT_STRENGTH
-                )
-                mpimg.imsave(str(output_file), result, cmap=plt.get_cmap("gray"), vmin=0.0, vmax=1.0)
-	    
+
+            checkpoint = None
+            if checkpoint_dir is not None:
+                checkpoint = load_checkpoint(checkpoint_dir, input_file, source_hash, last_nail_idx)
+
+            if checkpoint is not None:
+                print(f"Reusing checkpoint for {input_file.name}")
+                pull_order = checkpoint['pull_order']
+                shape = tuple(checkpoint['shape'])
+                needs_render = not output_file.exists() or str(checkpoint['render_hash']) != render_hash
             else:
-                orig_pic = rgb2gray(img) * 0.9
-                
-                image_dimens = int(SIDE_LEN * RADIUS1_MULTIPLIER), int(SIDE_LEN * RADIUS2_MULTIPLIER)
-                if WB:
-                    str_pic = init_canvas(shape, black=True)
-                    pull_order = create_art(nails, orig_pic, str_pic, 0.05, i_limit=PULL_AMOUNT, last_nail_idx=last_nail_idx)
-                    blank = init_canvas(image_dimens, black=True)
+                img = load()
+                shape = (len(img), len(img[0]))
+
+                report_path = report_dir / input_file.stem if instrumented else None
+                pull_order, str_pic = solve_section(img, last_nail_idx, config, executor, geometry_dir, report_path)
+                needs_render = True
+
+                if checkpoint_dir is not None:
+                    # Sin render_hash hasta que el render termine (ver mark_rendered)
+                    save_checkpoint(checkpoint_dir, input_file,
+                                    source_hash=source_hash, render_hash='',
+                                    pull_order=np.asarray(pull_order, dtype=np.uint16), str_pic=str_pic,
+                                    shape=np.asarray(shape), entry_nail=last_nail_idx,
+                                    exit_nail=exit_nail(pull_order, last_nail_idx))
+
+            if needs_render:
+                if executor is None:
+                    render_section(pull_order, shape, output_file, config, geometry_dir)
+                    if checkpoint_dir is not None:
+                        mark_rendered(checkpoint_dir, input_file, render_hash)
                 else:
-                    str_pic = init_canvas(shape, black=False)
-                    pull_order = create_art(nails, orig_pic, str_pic, -0.05, i_limit=PULL_AMOUNT, last_nail_idx=last_nail_idx)
-                    blank = init_canvas(image_dimens, black=False)
-	    
-                scaled_nails = scale_nails(
-                    image_dimens[1] / shape[1],
-                    image_dimens[0] / shape[0],
-                    nails
-                )
-	    
-                result = pull_order_to_array_bw(
-                    pull_order,
-                    blank,
-                    scaled_nails,
-                    EXPORT_STRENGTH if WB else -EXPORT_STRENGTH
-                )
-                mpimg.imsave(str(output_file), result, cmap=plt.get_cmap("gray"), vmin=0.0, vmax=1.0)
-	    
-                print(f"Thread pull order by nail index for {input_file.name}:\n{'-'.join([str(idx) for idx in pull_order])}")
+                    future = executor.submit(render_section, pull_order, shape, output_file, config, geometry_dir)
+                    rendered.append((input_file, future))
+
             # Escribir en instructions.txt
-            f.write(f"{'-'.join([str(idx) for idx in pull_order])}\n\n")
-            
+            if config['rgb']:
+                # Un renglón por color de hilo (r, g, b o los de 'palette'), cada uno con su propio largo
+                rows = colour_orders(pull_order, len(thread_effects(config)))
+                for colour_order in rows:
+                    instructions.write(f"{format_pull_order(colour_order)}\n")
+                instructions.write("\n")
+            else:
+                rows = [pull_order]
+                instructions.write(f"{format_pull_order(pull_order)}\n\n")
+            instructions.flush()
+            print(f"Thread pull order for {input_file.name}: {', '.join(str(len(row)) for row in rows)} nails")
+
+            section_exit = exit_nail(pull_order, last_nail_idx)
+            if binary is not None:
+                binary.write_section(input_file.name, rows, last_nail_idx, section_exit, nail_layout(shape, config),
+                                     colour_sequence=np.asarray(pull_order)[:, 0] if config['rgb'] else None)
+
             # Actualizar last_nail_idx con la última ranura de la sección actual
-            last_nail_idx = pull_order[-1]
-            print(f"Saved to {output_file}")
\ No newline at end of file
+            last_nail_idx = section_exit
+            print(f"Saved to {output_file}")
+
+        for input_file, future in rendered:
+            future.result()
+            if checkpoint_dir is not None:
+                mark_rendered(checkpoint_dir, input_file, render_hash)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return last_nail_idx
+
+def stored_sections(path, config, shape=None):
+    # (nombre, pull_order, forma, config) de cada sección de un instructions.txt o instructions.bin.
+    # El binario trae la distribución de puntillas de cada sección; el texto usa la de config y shape
+    # (por defecto long_side x long_side, como las secciones cuadradas de sections-export/).
+    # side_len y export_strength siempre salen de config
+    path = pathlib.Path(path)
+    if shape is None:
+        shape = (config['long_side'], config['long_side'])
+
+    if path.suffix == '.bin':
+        for section in instruction_file.InstructionReader(path):
+            layout = dict(section['layout'] or {})
+            section_shape = tuple(layout.pop('shape', shape))
+            section_config = dict(config, **{p: v for p, v in layout.items() if p not in RENDER_PARAMS})
+            rows = list(section['rows'])
+            yield section['name'], rows if section_config['rgb'] else rows[0], section_shape, section_config
+        return
+
+    for name, rows in instruction_file.read_text_instructions(path):
+        rows = [instruction_file.parse_order(row) for row in rows]
+        # Un renglón por color en las secciones RGB
+        section_config = dict(config, rgb=len(rows) > 1)
+        yield name, rows if section_config['rgb'] else rows[0], shape, section_config
+
+def replay_sections(path, output_dir, config, workers=1, shape=None, geometry_dir=None):
+    # Vuelve a exportar las secciones de un archivo de instrucciones sin resolverlas (p. ej. con otro
+    # side_len o export_strength). Las cuerdas a la resolución de exportación se rasterizan una vez
+    # en este proceso y los procesos de render las leen de geometry_dir
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if geometry_dir is None:
+        geometry_dir = checkpoint_dir / 'geometry'
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        rendered = []
+        for name, pull_order, section_shape, section_config in stored_sections(path, config, shape):
+            output_file = output_dir / name
+            export_chord_index(section_shape, section_config, geometry_dir)
+            if executor is None:
+                rendered.append(render_section(pull_order, section_shape, output_file, section_config, geometry_dir))
+            else:
+                rendered.append(executor.submit(render_section, pull_order, section_shape, output_file, section_config,
+                                                geometry_dir))
+        if executor is not None:
+            rendered = [future.result() for future in rendered]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return rendered
+
+if __name__ == '__main__':
+    WORKERS = os.cpu_count()  # Procesos para cargar y exportar secciones y resolver canales RGB (1 = todo en este proceso)
+    CHECKPOINTS = True  # Guardar cada sección en checkpoints/ y saltar las que no cambiaron
+    MODEL = None  # Nombre de un modelo de models.json: el STL se corta en memoria y no se lee sections-export/
+    DEBUG_SECTIONS = False  # Con MODEL: guardar también las secciones rasterizadas (a LONG_SIDE) en sections-solved/
+
+    parser = argparse.ArgumentParser(description='Solve string art sections')
+    parser.add_argument('input', nargs='?', default=str(input_dir),
+                        help='section folder, e.g. sections-export-<model>/ from cut-model.py (default: sections-export/)')
+    args = parser.parse_args()
+
+    config = dict(DEFAULT_CONFIG)
+
+    input_files = None
+    if MODEL is None:
+        # sections-export-apple/ -> string-sections-apple/, instructions-apple.txt, checkpoints/apple/
+        input_dir = pathlib.Path(args.input)
+        input_files = sorted(input_dir.glob('seccion_*.png'))
+        # Antes de abrir (y vaciar) los archivos de instrucciones
+        if not input_files:
+            parser.error(f"no seccion_*.png in {input_dir}/ (cut-model.py writes sections-export-<model>/)")
+        suffix = input_dir.name.removeprefix('sections-export')
+        if suffix:
+            output_dir = pathlib.Path(f'string-sections{suffix}')
+            instructions_file = f'instructions{suffix}.txt'
+            binary_instructions_file = f'instructions{suffix}.bin'
+            checkpoint_dir = checkpoint_dir / suffix.lstrip('-')
+
+    # Crear la carpeta de salida si no existe
+    output_dir.mkdir(exist_ok=True)
+
+    # Abrir los archivos de instrucciones (texto y binario); se reescriben completos en cada ejecución,
+    # las secciones ya resueltas se copian desde sus checkpoints
+    with open(instructions_file,'w') as f, instruction_file.InstructionWriter(binary_instructions_file) as binary:
+        f.write("Instructions:\n\n")
+
+        if MODEL is None:
+            # Procesar todas las imágenes de la carpeta de secciones
+            process_sections(input_files, output_dir, f, config, workers=WORKERS,
+                             checkpoint_dir=checkpoint_dir if CHECKPOINTS else None, binary=binary)
+        else:
+            model = slicing.load_model_configs()[MODEL]
+            # Carpeta aparte: las secciones a LONG_SIDE no pisan las de tamaño completo de sections-export/
+            debug_dir = pathlib.Path('sections-solved') if DEBUG_SECTIONS else None
+            images = stream_model_sections(model, config, debug_dir=debug_dir)
+            process_sections(None, output_dir, f, config, workers=WORKERS,
+                             checkpoint_dir=checkpoint_dir if CHECKPOINTS else None, images=images, binary=binary)
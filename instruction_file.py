@@ -0,0 +1,222 @@
+import argparse
+import json
+import pathlib
+import re
+import struct
+import numpy as np
+
+
+# Formato binario de instrucciones: una cabecera y un registro por sección, agregado al final a medida
+# que se resuelve. Cada registro es (largo de los metadatos, largo de los datos) en '<II', los metadatos
+# en JSON (nombre, puntillas de entrada y salida, largo de cada renglón, distribución de puntillas) y
+# los datos: cada renglón de puntillas como diferencias entre puntillas consecutivas en varint zigzag
+MAGIC = b'SAPO'
+FORMAT_VERSION = 1
+RECORD_HEADER = struct.Struct('<II')
+
+# Renglón de puntillas en el formato de texto (instructions.txt): números separados por '-'
+ORDER_LINE = re.compile(r'^[0-9-]*$')
+
+
+def encode_varints(values):
+    # Enteros no negativos -> bytes LEB128 (7 bits por byte, el bit alto marca que sigue otro byte)
+    values = np.asarray(values, dtype=np.int64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    shift = 7
+    while len(values) and (values >> shift).any():
+        nbytes += (values >> shift) > 0
+        shift += 7
+
+    out = np.empty(nbytes.sum(), dtype=np.uint8)
+    starts = np.cumsum(nbytes) - nbytes
+    for b in range(nbytes.max(initial=0)):
+        sel = nbytes > b
+        more = (nbytes[sel] > b + 1).astype(np.int64) << 7
+        out[starts[sel] + b] = ((values[sel] >> (7 * b)) & 0x7f) | more
+    return out.tobytes()
+
+def decode_varints(data):
+    data = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)  # Último byte de cada valor
+    starts = np.append(0, ends[:-1] + 1)[:len(ends)]
+    lengths = ends - starts + 1
+    values = np.zeros(len(ends), dtype=np.int64)
+    for b in range(lengths.max(initial=0)):
+        sel = lengths > b
+        values[sel] |= (data[starts[sel] + b].astype(np.int64) & 0x7f) << (7 * b)
+    return values
+
+def encode_order(order):
+    # Puntillas -> diferencias consecutivas (la primera respecto de 0) en zigzag, así los saltos
+    # cortos hacia atrás también ocupan un byte
+    deltas = np.diff(np.asarray(order, dtype=np.int64), prepend=0)
+    return encode_varints((deltas << 1) ^ (deltas >> 63))
+
+def decode_orders(zigzag, counts):
+    # Valores de varios renglones seguidos -> un arreglo uint16 por renglón (counts: puntillas de cada uno)
+    if not counts:
+        return []
+    deltas = (zigzag >> 1) ^ -(zigzag & 1)
+    return [np.cumsum(part).astype(np.uint16) for part in np.split(deltas, np.cumsum(counts)[:-1])]
+
+class InstructionWriter:
+    # Agrega secciones a un archivo binario a medida que se resuelven; cada sección se escribe
+    # completa y se vacía al disco, así un corte deja legibles todas las anteriores
+    def __init__(self, path, append=False):
+        self.path = pathlib.Path(path)
+        exists = append and self.path.exists() and self.path.stat().st_size > 0
+        self.file = open(self.path, 'ab' if exists else 'wb')
+        if not exists:
+            self.file.write(MAGIC + bytes([FORMAT_VERSION]))
+
+    def write_section(self, name, rows, entry_nail, exit_nail, layout=None, colour_sequence=None):
+        # rows: un recorrido de puntillas por color (uno solo en blanco y negro); colour_sequence:
+        # color de cada hilo en el orden en que se tienden (RGB), guardado como un renglón más
+        rows = [np.asarray(row) for row in rows]
+        meta = {
+            'name': str(name),
+            'entry_nail': int(entry_nail),
+            'exit_nail': int(exit_nail),
+            'rows': [len(row) for row in rows],
+            'layout': layout,
+        }
+        payload = b''.join(encode_order(row) for row in rows)
+        if colour_sequence is not None:
+            meta['colour_sequence'] = len(colour_sequence)
+            payload += encode_varints(colour_sequence)
+
+        meta = json.dumps(meta).encode()
+        self.file.write(RECORD_HEADER.pack(len(meta), len(payload)) + meta + payload)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class InstructionReader:
+    # Índice de las secciones (solo se leen las cabeceras y los metadatos); cada sección se decodifica
+    # al pedirla, por posición o por nombre. Un registro incompleto al final (corte durante la escritura)
+    # se ignora
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.index = []
+        with open(self.path, 'rb') as f:
+            header = f.read(len(MAGIC) + 1)
+            if header[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{self.path} is not a binary instruction file")
+            if header[len(MAGIC)] != FORMAT_VERSION:
+                raise ValueError(f"{self.path}: unsupported format version {header[len(MAGIC)]}")
+            size = self.path.stat().st_size
+            while True:
+                record = f.read(RECORD_HEADER.size)
+                if len(record) < RECORD_HEADER.size:
+                    break
+                meta_len, payload_len = RECORD_HEADER.unpack(record)
+                if f.tell() + meta_len + payload_len > size:
+                    break
+                meta = json.loads(f.read(meta_len))
+                self.index.append((meta, f.tell(), payload_len))
+                f.seek(payload_len, 1)
+        self.positions = {meta['name']: k for k, (meta, _, _) in enumerate(self.index)}
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        return [meta['name'] for meta, _, _ in self.index]
+
+    def section(self, key):
+        # key: posición o nombre ('seccion_001.png'). Devuelve los metadatos más 'rows' (uint16) y,
+        # si se guardó, 'colour_sequence'
+        meta, offset, payload_len = self.index[self.positions[key] if isinstance(key, str) else key]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            payload = f.read(payload_len)
+
+        values = decode_varints(payload)
+        nails_amount = sum(meta['rows'])
+        section = dict(meta)
+        section['rows'] = decode_orders(values[:nails_amount], meta['rows'])
+        if 'colour_sequence' in meta:
+            section['colour_sequence'] = values[nails_amount:].astype(np.uint8)
+        return section
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.section(k)
+
+def read_text_instructions(path):
+    # (nombre, renglones) de cada sección de un instructions.txt: el nombre, un renglón por color y una
+    # línea en blanco de separación (un renglón vacío es un color sin hilos: solo se descarta la última)
+    def section_rows(rows):
+        return rows[:-1] if rows and rows[-1] == '' else rows
+
+    name, rows = None, []
+    with open(path) as f:
+        next(f, None)  # 'Instructions:'
+        for line in f:
+            line = line.strip()
+            if line and not ORDER_LINE.match(line):
+                if name is not None:
+                    yield name, section_rows(rows)
+                name, rows = line, []
+            elif name is not None:
+                rows.append(line)
+    if name is not None:
+        yield name, section_rows(rows)
+
+def parse_order(line):
+    return np.array([int(nail) for nail in line.split('-')] if line else [], dtype=np.uint16)
+
+def write_text_section(f, name, rows):
+    f.write(f"{name}\n")
+    for row in rows:
+        f.write('-'.join(map(str, np.asarray(row).tolist())) + '\n')
+    f.write('\n')
+
+def rows_exit_nail(rows, entry_nail):
+    # Misma regla que generate.exit_nail sobre los hilos intercalados color por color: el último hilo es
+    # del color con más puntillas (el de índice más alto si empatan); entry_nail si no hubo hilos
+    longest = max(range(len(rows)), key=lambda k: (len(rows[k]), k), default=None)
+    if longest is None or len(rows[longest]) == 0:
+        return entry_nail
+    return int(rows[longest][-1])
+
+def text_to_binary(text_path, binary_path, layout=None):
+    # La entrada de cada sección es la salida de la anterior (0 en la primera), como en process_sections
+    entry_nail = 0
+    with InstructionWriter(binary_path) as writer:
+        for name, rows in read_text_instructions(text_path):
+            rows = [parse_order(row) for row in rows]
+            exit_nail = rows_exit_nail(rows, entry_nail)
+            writer.write_section(name, rows, entry_nail, exit_nail, layout)
+            entry_nail = exit_nail
+    return binary_path
+
+def binary_to_text(binary_path, text_path):
+    with open(text_path, 'w') as f:
+        f.write("Instructions:\n\n")
+        for section in InstructionReader(binary_path):
+            write_text_section(f, section['name'], section['rows'])
+    return text_path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert string art instructions between the text and binary formats')
+    parser.add_argument('direction', choices=['to-binary', 'to-text'])
+    parser.add_argument('input')
+    parser.add_argument('output', nargs='?', help='default: input with .bin / .txt suffix')
+    args = parser.parse_args(argv)
+
+    source = pathlib.Path(args.input)
+    if args.direction == 'to-binary':
+        print(text_to_binary(source, args.output or source.with_suffix('.bin')))
+    else:
+        print(binary_to_text(source, args.output or source.with_suffix('.txt')))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import argparse
+import os
+import pathlib
+import generate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Re-render string art sections from stored instructions, without solving')
+    parser.add_argument('instructions', help='instructions.txt / instructions-<model>.txt or a binary .bin file')
+    parser.add_argument('--output', help='output folder (default: string-sections-<instructions name>)')
+    parser.add_argument('--side-len', type=int, help='export size in pixels (default: DEFAULT_CONFIG)')
+    parser.add_argument('--export-strength', type=float, help='thread darkness in the export (default: DEFAULT_CONFIG)')
+    parser.add_argument('--long-side', type=int, help='text instructions: side the sections were solved at')
+    parser.add_argument('--nail-step', type=int, help='text instructions: nail spacing the sections were solved with')
+    parser.add_argument('--shape', type=int, nargs=2, metavar=('HEIGHT', 'WIDTH'),
+                        help='text instructions: solved section shape (default: LONG_SIDE x LONG_SIDE)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='sections rendered in parallel')
+    args = parser.parse_args(argv)
+
+    # Los .bin guardan la distribución de puntillas de cada sección; para el texto se toma de
+    # DEFAULT_CONFIG con estos ajustes
+    config = dict(generate.DEFAULT_CONFIG)
+    for param, value in (('side_len', args.side_len), ('export_strength', args.export_strength),
+                         ('long_side', args.long_side), ('nail_step', args.nail_step)):
+        if value is not None:
+            config[param] = value
+
+    instructions = pathlib.Path(args.instructions)
+    # instructions-apple.txt -> string-sections-apple/, instructions.txt -> string-sections/
+    output_dir = pathlib.Path(args.output or f"string-sections{instructions.stem.removeprefix('instructions')}")
+    rendered = generate.replay_sections(instructions, output_dir, config, workers=max(1, args.workers),
+                                        shape=args.shape)
+    print(f"{len(rendered)} sections rendered to {output_dir}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import json
+import trimesh
+import numpy as np
+from PIL import Image
+
+
+# Parámetros de rasterización de las secciones
+line_width = 10.0    # Ancho del contorno en puntos (ajusta según necesidad)
+dpi = 100
+image_size = 1182    # Lado en píxeles del área de ejes de la figura de 15.36" recortada con bbox_inches='tight'
+
+
+def load_model_configs(path='models.json'):
+    # Modelo -> path, num_sections, rotation_angle, direction, bounds_axis, x_limits, y_limits
+    with open(path) as f:
+        return json.load(f)
+
+def load_model(path, rotation_angle, direction, bounds_axis=2):
+    # Carga el STL, toma el rango de corte sobre bounds_axis (antes de rotar) y aplica la rotación
+    mesh = trimesh.load(path)
+    z_min, z_max = mesh.bounds[0][bounds_axis], mesh.bounds[1][bounds_axis]
+    rotation_matrix = trimesh.transformations.rotation_matrix(
+        angle=np.deg2rad(rotation_angle),  # Convierte a radianes
+        direction=direction,
+        point=[0, 0, 0]                   # Rota alrededor del origen (0, 0, 0)
+    )
+    mesh.apply_transform(rotation_matrix)
+    return mesh, z_min, z_max
+
+def section_segments(section):
+    # Segmentos (inicio, fin) en XY de todas las entidades, cerrando cada bucle
+    vertices_2d = section.vertices[:, :2]  # Proyecta al plano XY (ignora Z)
+    starts = np.concatenate([entity.points for entity in section.entities])
+    ends = np.concatenate([np.roll(entity.points, -1) for entity in section.entities])
+    return vertices_2d[starts], vertices_2d[ends]
+
+def sliced_segments(mesh, z_positions, batched=True):
+    # Segmentos (inicio, fin) en XY de cada plano z; None si el plano no corta el modelo
+    if not batched:
+        for z in z_positions:
+            # Define el plano de corte en el sistema de coordenadas global
+            section = mesh.section(plane_origin=[0, 0, z], plane_normal=[0, 0, 1])
+            yield section_segments(section) if section else None
+        return
+
+    # mesh_multiplane clasifica los triángulos contra todas las alturas de una vez
+    lines, to_3d, _ = trimesh.intersections.mesh_multiplane(
+        mesh, plane_origin=[0, 0, 0], plane_normal=[0, 0, 1], heights=z_positions)
+    for segments, transform in zip(lines, to_3d):
+        if len(segments) == 0:
+            yield None
+            continue
+        # Los segmentos vienen en el marco 2D del plano; se llevan al espacio global y se proyectan a XY
+        points = np.column_stack((segments.reshape(-1, 2), np.zeros(2 * len(segments))))
+        points_2d = trimesh.transform_points(points, transform)[:, :2].reshape(-1, 2, 2)
+        yield points_2d[:, 0], points_2d[:, 1]
+
+def rasterize_segments(starts, ends, x_limits, y_limits, size, width_px):
+    # Lienzo booleano: True donde pasa un contorno
+    scale = np.array([size / (x_limits[1] - x_limits[0]), size / (y_limits[1] - y_limits[0])])
+    origin = np.array([x_limits[0], y_limits[1]])
+    flip = np.array([1, -1])  # El eje y de la imagen crece hacia abajo
+    p0 = (starts - origin) * flip * scale
+    p1 = (ends - origin) * flip * scale
+
+    # Muestras cada medio píxel a lo largo de todos los segmentos en una sola pasada
+    samples = np.maximum(np.ceil(np.linalg.norm(p1 - p0, axis=1) * 2).astype(int), 1) + 1
+    segment = np.repeat(np.arange(len(p0)), samples)
+    t = (np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)) / np.repeat(samples - 1, samples)
+    points = p0[segment] + (p1 - p0)[segment] * t[:, None]
+    cols, rows = np.floor(points).astype(int).T
+    inside = (rows >= 0) & (rows < size) & (cols >= 0) & (cols < size)
+    thin = np.zeros((size, size), dtype=bool)
+    thin[rows[inside], cols[inside]] = True
+
+    # Engrosa la línea con un disco del ancho indicado (dilatación por desplazamientos)
+    radius = width_px / 2
+    r = int(np.ceil(radius))
+    padded = np.pad(thin, r)
+    mask = np.zeros_like(thin)
+    for dy in range(-r, r + 1):
+        for dx in range(-r, r + 1):
+            if dy * dy + dx * dx <= radius * radius:
+                mask |= padded[r + dy:r + dy + size, r + dx:r + dx + size]
+    return mask
+
+def slice_model(mesh, z_positions, x_limits, y_limits, size=image_size, batched=True):
+    # (índice, máscara) de cada plano que corta el modelo; el grosor del contorno escala con size
+    width_px = line_width * dpi / 72 * size / image_size
+    for i, segments in enumerate(sliced_segments(mesh, z_positions, batched)):
+        if segments is not None:
+            starts, ends = segments
+            yield i, rasterize_segments(starts, ends, x_limits, y_limits, size, width_px)
+
+def section_name(i):
+    return f'seccion_{i:03d}.png'
+
+def mask_to_image(mask):
+    # Imagen RGB en [0, 1] como la que devuelve generate.load_section: contorno negro sobre blanco
+    return np.repeat(1.0 - mask[..., None], 3, axis=2)
+
+def save_section(mask, path):
+    # Contorno negro sobre fondo blanco opaco, en RGBA como las exportaciones anteriores
+    image = np.full(mask.shape + (4,), 255, dtype=np.uint8)
+    image[mask, :3] = 0
+    Image.fromarray(image, 'RGBA').save(path)
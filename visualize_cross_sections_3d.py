@@ -1,9 +1,16 @@
 import platform as py_platform
 import pygame
 from pygame.locals import *
-from OpenGL.GL import *
-from OpenGL.GLU import *
 import os
+import argparse
+import hashlib
+import ctypes
+import math
+import time
+import pathlib
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 # Parameters
@@ -16,56 +23,182 @@ y_limits = (-650, 650)  # Y-axis limits (will be scaled)
 scale_factor = 100.0  # Scale down the model size
 alpha = 0.9  # Overall opacity of images (1.0 since transparency is handled per pixel)
 white_threshold = 200  # Threshold for pixels to be considered white (stricter to avoid affecting hilos)
+texture_size = 512  # Per-section texture side in the atlas (power of two; halved if the atlas would not fit)
+min_mip_size = 8  # Smallest mip level kept per section
+uploads_per_frame = 4  # Sections uploaded to the GPU per frame while loading
+cache_dir = pathlib.Path('.texture-cache')  # Preprocessed RGBA mip chains, keyed on the PNG mtime
+
+# PyOpenGL, imported by init_viewer: --headless renders without it (or libGL)
+gl = glu = None
 
-# Initialize Pygame and OpenGL
-pygame.init()
 display = (800, 600)
-pygame.display.set_mode(display, DOUBLEBUF | OPENGL)
-gluPerspective(45, (display[0] / display[1]), 0.1, 500.0)
-glTranslatef(0.0, 0.0, -20.0)  # Initial camera position
-
-# Configure OpenGL
-glEnable(GL_TEXTURE_2D)
-glEnable(GL_BLEND)
-glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-glClearColor(1.0, 1.0, 1.0, 1.0)  # Set background to white
-glDisable(GL_CULL_FACE)  # Disable back-face culling to render both sides of quads
-
-# Count the number of PNG files in the folder and load textures
-textures = []
-if os.path.exists(folder_name):
-    # Get list of PNG files in the folder
-    image_files = [f for f in os.listdir(folder_name) if f.endswith('.png')]
-    num_sections = len(image_files)
-    for i, img_file in enumerate(sorted(image_files), 1):  # Sort to ensure consistent order
-        img_path = os.path.join(folder_name, img_file)
+fov_y = 45  # Vertical field of view in degrees
+camera_distance = 20.0  # Initial camera position along -Z
+
+def section_rgba(img_path):
+    # Section PNG as an RGBA array in surfarray layout (width, height, 4), with white made transparent
+    surface = pygame.image.load(img_path)
+    img_data = pygame.surfarray.array3d(surface)
+    alpha_data = np.ones((img_data.shape[0], img_data.shape[1]), dtype=np.uint8) * 255
+    # Set alpha to 0 for nearly white pixels (stricter threshold)
+    white_mask = (img_data[:, :, 0] >= white_threshold) & (img_data[:, :, 1] >= white_threshold) & (img_data[:, :, 2] >= white_threshold)
+    alpha_data[white_mask] = 0
+    # Combine RGB and alpha into RGBA
+    return np.dstack((img_data, alpha_data))
+
+def resize_rgba(rgba, size):
+    # Box-average down to size x size (nearest neighbour if the image is smaller)
+    height, width = rgba.shape[:2]
+    if size >= height or size >= width:
+        rows = np.arange(size) * height // size
+        cols = np.arange(size) * width // size
+        return rgba[rows][:, cols]
+    rows = np.arange(size) * height // size
+    cols = np.arange(size) * width // size
+    summed = np.add.reduceat(np.add.reduceat(rgba.astype(np.float32), rows, axis=0), cols, axis=1)
+    counts = np.diff(np.append(rows, height))[:, None] * np.diff(np.append(cols, width))[None, :]
+    return (summed / counts[:, :, None]).astype(np.uint8)
+
+def mip_chain(rgba, min_size):
+    # Level 0 plus successive 2x2 averages down to min_size
+    levels = [rgba]
+    while levels[-1].shape[0] > min_size:
+        level = levels[-1].astype(np.float32)
+        level = (level[0::2, 0::2] + level[1::2, 0::2] + level[0::2, 1::2] + level[1::2, 1::2]) / 4
+        levels.append(level.astype(np.uint8))
+    return levels
+
+def section_levels(img_path, tile):
+    # Mip chain of one section, cached on disk and reused while the PNG's mtime and settings are unchanged
+    img_path = pathlib.Path(img_path)
+    key = f"{img_path.stat().st_mtime_ns}-{white_threshold}-{tile}-{min_mip_size}"
+    # One cache folder per section folder, keyed on its resolved path so equally named folders do not collide
+    folder = img_path.resolve().parent
+    folder_key = hashlib.sha256(str(folder).encode()).hexdigest()[:16]
+    cache_path = cache_dir / f"{folder.name}-{folder_key}" / f"{img_path.stem}.npz"
+    if cache_path.exists():
+        with np.load(cache_path) as data:
+            if str(data['key']) == key:
+                return [data[f'level{level}'] for level in range(len(data.files) - 1)]
+
+    levels = mip_chain(resize_rgba(section_rgba(str(img_path)), tile), min_mip_size)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Per-process temp file: headless workers may preprocess the same folder at the same time
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp.npz')
+    np.savez(tmp_path, key=key, **{f'level{level}': data for level, data in enumerate(levels)})
+    os.replace(tmp_path, cache_path)
+    return levels
+
+def load_section(i, img_path, tile, loaded):
+    # Decodes, preprocesses and mip-maps one section, then hands it to the render loop
+    try:
+        loaded.put((i, section_levels(img_path, tile)))
+    except Exception as e:
+        print(f"Error loading {img_path}: {e}")
+
+def load_sections(image_paths, tile, loaded):
+    # Background loader thread
+    for i, img_path in enumerate(image_paths):
+        load_section(i, img_path, tile, loaded)
+
+class SectionAtlas:
+    # All sections packed as a grid of tile x tile cells in one mip-mapped texture, filled progressively
+    def __init__(self, count, tile):
+        self.cols = max(1, math.ceil(math.sqrt(count)))
+        self.rows = max(1, math.ceil(count / self.cols))
+        max_size = gl.glGetIntegerv(gl.GL_MAX_TEXTURE_SIZE)
+        while tile > min_mip_size and max(self.cols, self.rows) * tile > max_size:
+            tile //= 2
+        self.tile = tile
+        self.levels = int(math.log2(tile // min_mip_size)) + 1
+        self.ready = [False] * count
+
+        self.texture_id = gl.glGenTextures(1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_id)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR_MIPMAP_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAX_LEVEL, self.levels - 1)
+        for level in range(self.levels):
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, level, gl.GL_RGBA, (self.cols * tile) >> level, (self.rows * tile) >> level,
+                            0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, None)
+
+    def upload(self, index, levels):
+        row, col = divmod(index, self.cols)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_id)
+        for level in range(self.levels):
+            size = self.tile >> level
+            gl.glTexSubImage2D(gl.GL_TEXTURE_2D, level, col * size, row * size, size, size,
+                               gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, np.ascontiguousarray(levels[level]).tobytes())
+        self.ready[index] = True
+
+    def texcoords(self, index):
+        # (s0, t0, s1, t1) of the cell, inset by half a texel so neighbours do not bleed in
+        row, col = divmod(index, self.cols)
+        inset = 0.5 / self.tile
+        return ((col + inset) / self.cols, (row + inset) / self.rows,
+                (col + 1 - inset) / self.cols, (row + 1 - inset) / self.rows)
+
+def section_paths(folder):
+    # PNG files of a section folder, in stacking order
+    if not os.path.exists(folder):
+        print(f"Folder {folder} does not exist.")
+        return []
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.endswith('.png')]
+
+def init_viewer(folder, background=True):
+    # Initialize Pygame and OpenGL, then start loading the sections in the background; they are drawn as they arrive.
+    # background=False (no threads, e.g. Pyodide): the caller loads them with load_section between frames
+    global gl, glu, image_paths, num_sections, atlas, loaded_sections, loader, section_vbo
+    from OpenGL import GL as gl, GLU as glu
+    pygame.init()
+    pygame.display.set_mode(display, DOUBLEBUF | OPENGL)
+    glu.gluPerspective(fov_y, (display[0] / display[1]), 0.1, 500.0)
+    gl.glTranslatef(0.0, 0.0, -camera_distance)  # Initial camera position
+
+    # Configure OpenGL
+    gl.glEnable(gl.GL_TEXTURE_2D)
+    gl.glEnable(gl.GL_BLEND)
+    gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+    gl.glClearColor(1.0, 1.0, 1.0, 1.0)  # Set background to white
+    gl.glDisable(gl.GL_CULL_FACE)  # Disable back-face culling to render both sides of quads
+
+    image_paths = section_paths(folder)
+    num_sections = len(image_paths)
+    atlas = SectionAtlas(num_sections, texture_size)
+    loaded_sections = queue.Queue()
+    loader = None
+    if background:
+        loader = threading.Thread(target=load_sections, args=(image_paths, atlas.tile, loaded_sections), daemon=True)
+        loader.start()
+    section_vbo = build_section_quads(atlas, num_sections)
+
+def upload_loaded_sections():
+    # Upload a few finished sections per frame so the first frame is not delayed; returns how many
+    for uploaded in range(uploads_per_frame):
         try:
-            surface = pygame.image.load(img_path)
-            # Convert surface to RGBA array
-            img_data = pygame.surfarray.array3d(surface)
-            alpha_data = np.ones((img_data.shape[0], img_data.shape[1]), dtype=np.uint8) * 255
-            # Set alpha to 0 for nearly white pixels (stricter threshold)
-            white_mask = (img_data[:, :, 0] >= white_threshold) & (img_data[:, :, 1] >= white_threshold) & (img_data[:, :, 2] >= white_threshold)
-            alpha_data[white_mask] = 0
-            # Combine RGB and alpha into RGBA
-            rgba_data = np.dstack((img_data, alpha_data))
-            # Convert back to raw data for OpenGL
-            data = rgba_data.tobytes()
-            width, height = surface.get_size()
-            
-            texture_id = glGenTextures(1)
-            glBindTexture(GL_TEXTURE_2D, texture_id)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, data)
-            textures.append((texture_id, width, height, i * z_separation))  # Store z-position
-        except Exception as e:
-            print(f"Error loading {img_path}: {e}")
-    else:
-        textures.append(None)
-else:
-    print(f"Folder {folder_name} does not exist.")
-    num_sections = 0
+            index, levels = loaded_sections.get_nowait()
+        except queue.Empty:
+            return uploaded
+        atlas.upload(index, levels)
+    return uploads_per_frame
+
+def build_section_quads(atlas, count):
+    # One VBO with every section quad: (s, t, x, y, z) per vertex, 4 vertices per section
+    x0, x1 = x_limits[0]/scale_factor, x_limits[1]/scale_factor
+    y0, y1 = y_limits[0]/scale_factor, y_limits[1]/scale_factor
+    vertices = []
+    for i in range(count):
+        z = (i + 1) * z_separation
+        s0, t0, s1, t1 = atlas.texcoords(i)
+        # Define vertices in clockwise order to ensure front face is upward
+        vertices += [(s0, t0, x0, y0, z), (s0, t1, x0, y1, z), (s1, t1, x1, y1, z), (s1, t0, x1, y0, z)]
+    vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 5)
+
+    vbo = gl.glGenBuffers(1)
+    gl.glBindBuffer(gl.GL_ARRAY_BUFFER, vbo)
+    gl.glBufferData(gl.GL_ARRAY_BUFFER, vertices.nbytes, vertices, gl.GL_STATIC_DRAW)
+    gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+    return vbo
 
 # Variables for interaction
 angle_x, angle_y = -90, 0  # Initial rotation to align Z with screen Y
@@ -73,86 +206,245 @@ trans_x, trans_y, trans_z = 0, -10, -20.0  # Adjusted camera translation
 last_pos_left = None  # For rotation (left mouse button)
 last_pos_right = None  # For translation (right mouse button)
 
-def update_loop():
-    global angle_x, angle_y, trans_x, trans_y, trans_z, last_pos_left, last_pos_right
-    
-    for event in pygame.event.get():
-        if event.type == QUIT:
-            return False  # Signal to exit the loop
-        elif event.type == MOUSEBUTTONDOWN:
-            if event.button == 1:  # Left button for rotation
-                last_pos_left = pygame.mouse.get_pos()
-            elif event.button == 3:  # Right button for translation
-                last_pos_right = pygame.mouse.get_pos()
-        elif event.type == MOUSEBUTTONUP:
-            if event.button == 1:
-                last_pos_left = None
-            elif event.button == 3:
-                last_pos_right = None
-        elif event.type == MOUSEMOTION:
-            x, y = pygame.mouse.get_pos()
-            if last_pos_left:  # Rotate
-                dx, dy = x - last_pos_left[0], y - last_pos_left[1]
-                angle_x += dy * 0.5
-                angle_y += dx * 0.5
-                last_pos_left = (x, y)
-            if last_pos_right:  # Translate
-                dx, dy = x - last_pos_right[0], y - last_pos_right[1]
-                trans_x += dx * 0.01
-                trans_y -= dy * 0.01  # Invert Y for intuitive movement
-                last_pos_right = (x, y)
-        elif event.type == MOUSEWHEEL:  # Zoom
-            trans_z += event.y * 0.5  # Positive for zoom in, negative for zoom out
-            trans_z = max(-100.0, min(-1.0, trans_z))  # Limit zoom range
-    
-    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-    glPushMatrix()
-    glTranslatef(trans_x, trans_y, trans_z)
-    glRotatef(angle_x, 1, 0, 0)
-    glRotatef(angle_y, 0, 0, 1)
-    
-    # Sort textures by z-position (nearest to farthest for correct transparency)
-    valid_textures = [(t[3], t) for t in textures if t is not None]
-    valid_textures.sort(reverse=False)  # Nearest to farthest (last to first)
-    
-    # Render quads with transparency handling
-    glDisable(GL_DEPTH_TEST)  # Disable depth test to prevent occlusion of transparent layers
-    for z, texture_info in valid_textures:
-        texture_id, width, height, _ = texture_info
-        
-        glBindTexture(GL_TEXTURE_2D, texture_id)
-        glBegin(GL_QUADS)
-        glColor4f(1.0, 1.0, 1.0, alpha)
-        # Define vertices in clockwise order to ensure front face is upward
-        glTexCoord2f(0, 0); glVertex3f(x_limits[0]/scale_factor, y_limits[0]/scale_factor, z)
-        glTexCoord2f(0, 1); glVertex3f(x_limits[0]/scale_factor, y_limits[1]/scale_factor, z)
-        glTexCoord2f(1, 1); glVertex3f(x_limits[1]/scale_factor, y_limits[1]/scale_factor, z)
-        glTexCoord2f(1, 0); glVertex3f(x_limits[1]/scale_factor, y_limits[0]/scale_factor, z)
-        glEnd()
-    
-    glPopMatrix()
+# Draw order cache: recomputed only when the camera moves or a new section arrives
+draw_key = None
+draw_indices = np.zeros(0, dtype=np.uint32)
+show_stats = True  # Frame time overlay (toggle with F)
+frame_time = 0.0
+stats_font = None
+
+def section_draw_order(modelview):
+    # Ready sections sorted back to front along the view direction, as quad vertex indices
+    ready = np.flatnonzero(atlas.ready)
+    # Eye-space depth of each section plane's centre (PyOpenGL returns the column-major matrix transposed)
+    centre_x = (x_limits[0] + x_limits[1]) / 2 / scale_factor
+    centre_y = (y_limits[0] + y_limits[1]) / 2 / scale_factor
+    z = (ready + 1) * z_separation
+    eye_z = modelview[0][2] * centre_x + modelview[1][2] * centre_y + modelview[2][2] * z + modelview[3][2]
+    ordered = ready[np.argsort(eye_z, kind='stable')]  # Most negative eye z = farthest, drawn first
+    return (ordered[:, None] * 4 + np.arange(4)).reshape(-1).astype(np.uint32)
+
+def draw_stats():
+    global stats_font
+    if stats_font is None:
+        pygame.font.init()
+        stats_font = pygame.font.SysFont(None, 22)
+    fps = 1.0 / frame_time if frame_time > 0 else 0.0
+    text = f"{frame_time * 1000:.1f} ms/frame ({fps:.0f} FPS), {int(np.sum(atlas.ready))}/{num_sections} sections"
+    surface = stats_font.render(text, True, (0, 0, 0), (255, 255, 255))
+    data = pygame.image.tostring(surface, 'RGBA', True)
+    gl.glWindowPos2d(8, 8)
+    gl.glDrawPixels(surface.get_width(), surface.get_height(), gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, data)
+
+def handle_event(event):
+    # Returns None to quit, True if the view changed
+    global angle_x, angle_y, trans_x, trans_y, trans_z, last_pos_left, last_pos_right, show_stats
+    if event.type == QUIT:
+        return None
+    elif event.type == MOUSEBUTTONDOWN:
+        if event.button == 1:  # Left button for rotation
+            last_pos_left = pygame.mouse.get_pos()
+        elif event.button == 3:  # Right button for translation
+            last_pos_right = pygame.mouse.get_pos()
+    elif event.type == MOUSEBUTTONUP:
+        if event.button == 1:
+            last_pos_left = None
+        elif event.button == 3:
+            last_pos_right = None
+    elif event.type == MOUSEMOTION:
+        x, y = pygame.mouse.get_pos()
+        if last_pos_left:  # Rotate
+            dx, dy = x - last_pos_left[0], y - last_pos_left[1]
+            angle_x += dy * 0.5
+            angle_y += dx * 0.5
+            last_pos_left = (x, y)
+        if last_pos_right:  # Translate (both apply when both buttons are held)
+            dx, dy = x - last_pos_right[0], y - last_pos_right[1]
+            trans_x += dx * 0.01
+            trans_y -= dy * 0.01  # Invert Y for intuitive movement
+            last_pos_right = (x, y)
+        return bool(last_pos_left or last_pos_right)
+    elif event.type == MOUSEWHEEL:  # Zoom
+        trans_z += event.y * 0.5  # Positive for zoom in, negative for zoom out
+        trans_z = max(-100.0, min(-1.0, trans_z))  # Limit zoom range
+        return True
+    elif event.type == KEYDOWN and event.key == K_f:
+        show_stats = not show_stats
+        return True
+    elif event.type in (VIDEOEXPOSE, WINDOWEVENT):
+        return True
+    return False
+
+def apply_camera():
+    gl.glTranslatef(trans_x, trans_y, trans_z)
+    gl.glRotatef(angle_x, 1, 0, 0)
+    gl.glRotatef(angle_y, 0, 0, 1)
+
+def camera_matrix():
+    # Camera transform alone (the base matrix also holds the perspective, which would flip the depth sign)
+    gl.glPushMatrix()
+    gl.glLoadIdentity()
+    apply_camera()
+    matrix = gl.glGetFloatv(gl.GL_MODELVIEW_MATRIX)
+    gl.glPopMatrix()
+    return matrix
+
+def render():
+    global draw_key, draw_indices, frame_time
+    start = time.perf_counter()
+    key = (angle_x, angle_y, trans_x, trans_y, trans_z, int(np.sum(atlas.ready)))
+    if key != draw_key:
+        draw_indices = section_draw_order(camera_matrix())
+        draw_key = key
+
+    gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+    gl.glPushMatrix()
+    apply_camera()
+
+    # Render quads with transparency handling (sections not loaded yet are skipped)
+    gl.glDisable(gl.GL_DEPTH_TEST)  # Disable depth test to prevent occlusion of transparent layers
+    if len(draw_indices) > 0:
+        gl.glBindTexture(gl.GL_TEXTURE_2D, atlas.texture_id)
+        gl.glColor4f(1.0, 1.0, 1.0, alpha)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, section_vbo)
+        gl.glEnableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+        gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glTexCoordPointer(2, gl.GL_FLOAT, 20, ctypes.c_void_p(0))
+        gl.glVertexPointer(3, gl.GL_FLOAT, 20, ctypes.c_void_p(8))
+        gl.glDrawElements(gl.GL_QUADS, len(draw_indices), gl.GL_UNSIGNED_INT, draw_indices)
+        gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glDisableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+    gl.glPopMatrix()
+    if show_stats:
+        gl.glFinish()
+        frame_time = time.perf_counter() - start
+        draw_stats()
     pygame.display.flip()
+
+def update_loop(wait=True):
+    # Redraws only when the view changed or new sections arrived; blocks on input once everything is loaded
+    loading = not all(atlas.ready) and ((loader is not None and loader.is_alive()) or not loaded_sections.empty())
+    if wait:
+        events = [pygame.event.wait(16)] if loading else [pygame.event.wait()]
+        events += pygame.event.get()
+    else:
+        events = pygame.event.get()
+
+    changed = False
+    for event in events:
+        result = handle_event(event)
+        if result is None:
+            return False  # Signal to exit the loop
+        changed = changed or result
+
+    uploaded = upload_loaded_sections()
+    if changed or uploaded:
+        render()
     return True  # Continue the loop
 
-def main():
-    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+def rotation_x(degrees):
+    c, s = math.cos(math.radians(degrees)), math.sin(math.radians(degrees))
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+def rotation_z(degrees):
+    c, s = math.cos(math.radians(degrees)), math.sin(math.radians(degrees))
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+def composite_sections(sections, size, view_angle_x, view_angle_y, translation):
+    # Software renderer: casts one ray per pixel with the same camera as the interactive view and
+    # alpha-blends the section planes back to front over a white background, like GL_SRC_ALPHA blending
+    width, height = size
+    rotation = rotation_x(view_angle_x) @ rotation_z(view_angle_y)
+    eye_offset = np.array([translation[0], translation[1], translation[2] - camera_distance])
+    # Model-space camera position and per-pixel ray directions (eye looks down -Z)
+    origin = rotation.T @ -eye_offset
+    tan_half = math.tan(math.radians(fov_y) / 2)
+    px = (2 * (np.arange(width) + 0.5) / width - 1) * tan_half * width / height
+    py = (1 - 2 * (np.arange(height) + 0.5) / height) * tan_half
+    directions = np.stack(np.broadcast_arrays(px[None, :], py[:, None], -1.0), axis=-1) @ rotation
+
+    x0, x1 = x_limits[0]/scale_factor, x_limits[1]/scale_factor
+    y0, y1 = y_limits[0]/scale_factor, y_limits[1]/scale_factor
+    image = np.ones((height, width, 3), dtype=np.float32)
+    # Planes farther from the camera first (same order as section_draw_order)
+    order = sorted(range(len(sections)), key=lambda i: -abs((i + 1) * z_separation - origin[2]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in order:
+            rgba = sections[i]
+            t = ((i + 1) * z_separation - origin[2]) / directions[..., 2]
+            x = origin[0] + t * directions[..., 0]
+            y = origin[1] + t * directions[..., 1]
+            s_coord = (x - x0) / (x1 - x0)
+            t_coord = (y - y0) / (y1 - y0)
+            hit = (t > 0.1) & (t < 500.0) & (s_coord >= 0) & (s_coord < 1) & (t_coord >= 0) & (t_coord < 1)
+            # Texel (s, t) is rgba[t, s], as uploaded by glTexImage2D from the surfarray layout
+            rows = (t_coord[hit] * rgba.shape[0]).astype(int)
+            cols = (s_coord[hit] * rgba.shape[1]).astype(int)
+            texel = rgba[rows, cols].astype(np.float32) / 255
+            a = texel[:, 3:] * alpha
+            image[hit] = texel[:, :3] * a + image[hit] * (1 - a)
+    return (image * 255).astype(np.uint8)
+
+def render_turntable(folder, output_dir, angles, size=display, view_angle_x=-90, translation=(0, -10, -20.0)):
+    # Headless: one PNG per angle (rotation around the stack axis) for a section folder, no display needed
+    sections = [section_levels(path, texture_size)[0] for path in section_paths(folder)]
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    frames = []
+    for frame, angle in enumerate(angles):
+        image = composite_sections(sections, size, view_angle_x, angle, translation)
+        frame_path = output_dir / f"{pathlib.Path(folder).name}-{frame:03d}.png"
+        # surfarray uses (width, height) order
+        pygame.image.save(pygame.surfarray.make_surface(image.transpose(1, 0, 2)), str(frame_path))
+        frames.append(frame_path)
+    return frames
+
+def main(folder=folder_name):
+    emscripten = py_platform.system() == "Emscripten"
+    init_viewer(folder, background=not emscripten)
+    render()
     
-    if py_platform.system() == "Emscripten":
-        # Code for Pyodide (keep asyncio)
+    if emscripten:
+        # Code for Pyodide (keep asyncio): no threads, so one section is loaded per frame from the event loop
         import asyncio
         async def pyodide_main():
+            for i, img_path in enumerate(image_paths):
+                load_section(i, img_path, atlas.tile, loaded_sections)
+                if not update_loop(wait=False):
+                    return
+                await asyncio.sleep(0)
             while True:
-                if not update_loop():
+                if not update_loop(wait=False):
                     break
                 await asyncio.sleep(1.0 / 60)
         asyncio.ensure_future(pyodide_main())
     else:
-        # Synchronous loop for desktop environments
+        # Synchronous loop for desktop environments: sleeps until there is something to draw
         running = True
         while running:
             running = update_loop()
-            pygame.time.Clock().tick(60)  # Limit to 60 FPS
 
 if __name__ == "__main__":
-    main()
-    pygame.quit()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='3D preview of stacked cross-sections')
+    parser.add_argument('folders', nargs='*', default=[folder_name], help='section folders (interactive mode uses the first)')
+    parser.add_argument('--headless', action='store_true', help='render images without a display')
+    parser.add_argument('--frames', type=int, default=1, help='headless: turntable frames over 360 degrees')
+    parser.add_argument('--angles', nargs='+', type=float, help='headless: explicit rotation angles (overrides --frames)')
+    parser.add_argument('--elevation', type=float, default=-90, help='headless: rotation around X (as angle_x)')
+    parser.add_argument('--size', nargs=2, type=int, default=list(display), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--output', default='previews', help='headless: output folder')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='headless: folders rendered in parallel')
+    args = parser.parse_args()
+
+    if args.headless:
+        angles = args.angles if args.angles else [360 * k / args.frames for k in range(args.frames)]
+        with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(args.folders)))) as executor:
+            futures = [executor.submit(render_turntable, folder, args.output, angles, tuple(args.size), args.elevation)
+                       for folder in args.folders]
+            for future in futures:
+                print(f"Saved {len(future.result())} frame(s)")
+    else:
+        main(args.folders[0])
+        pygame.quit()